@@ -0,0 +1,76 @@
+# This file is part of Hangouts GTK
+# Copyright © 2019-2020 Dominik Schütz <do.sch.dev@gmail.com>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import math
+import cairo
+
+from gi.repository import Gdk
+
+MAX_AVATAR_IMAGES = 4
+
+
+# circles (center x, center y, radius) for 1 to 4 images in a size x size square
+def avatar_layout(count, size):
+    half = size * .5
+    quarter = size * .25
+
+    if count == 1:
+        return ((half, half, half), )
+    elif count == 2:
+        radius = math.sqrt(size * size * 2) / (2 + 2 * math.sqrt(2))
+        return (
+            (radius, radius, radius),
+            (size - radius, size - radius, radius)
+        )
+    elif count == 3:
+        offset = quarter * (1 - math.sqrt(3) / 2)
+        threequaroff = quarter + half - offset
+        return (
+            (half, quarter + offset, quarter),
+            (quarter, threequaroff, quarter),
+            (half + quarter, threequaroff, quarter)
+        )
+    else:
+        threequar = half + quarter
+        return (
+            (quarter, quarter, quarter),
+            (threequar, quarter, quarter),
+            (quarter, threequar, quarter),
+            (threequar, threequar, quarter)
+        )
+
+
+# paints the pixbufs clipped to circles on one surface
+def render_avatar(pixbufs, size):
+    size = int(size)
+    surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, size, size)
+    cr = cairo.Context(surface)
+
+    for pixbuf, (x, y, radius) in zip(pixbufs, avatar_layout(len(pixbufs), size)):
+        width, height = pixbuf.get_width(), pixbuf.get_height()
+        scale = 2 * radius / min(width, height)
+
+        cr.save()
+        cr.arc(x, y, radius, 0, 2 * math.pi)
+        cr.clip()
+        cr.translate(x - width * scale * .5, y - height * scale * .5)
+        cr.scale(scale, scale)
+        Gdk.cairo_set_source_pixbuf(cr, pixbuf, 0, 0)
+        cr.paint()
+        cr.restore()
+
+    surface.flush()
+    return surface
@@ -18,25 +18,21 @@
 # SPDX-License-Identifier: GPL-3.0-or-later
 
 
-import asyncio
-
-from gi.repository.GLib import idle_add
-
 class Client:
     hangups_client = NotImplemented
-    queue = NotImplemented
-    loop = NotImplemented
+    scheduler = NotImplemented
+    dispatcher = NotImplemented
 
-    def __init__(self, hangups_client, queue):
+    def __init__(self, hangups_client, scheduler, dispatcher):
         self.hangups_client = hangups_client
-        self.queue = queue
-        self.loop = asyncio.get_running_loop()
+        self.scheduler = scheduler
+        self.dispatcher = dispatcher
 
     def connect_on_event(self, callback):
         print("Client.connect_on_event")
         def _callback(event):
             print("Client.connect_on_event.callback")
-            idle_add(callback, event)
+            self.dispatcher.dispatch(callback, event)
         self.hangups_client.on_connect.add_observer(_callback)
         return _callback
 
@@ -45,7 +41,7 @@ class Client:
 
     def connect_on_reconnect(self, callback):
         def _callback(event):
-            idle_add(callback, event)
+            self.dispatcher.dispatch(callback, event)
         self.hangups_client.on_reconnect.add_observer(_callback)
         return _callback
 
@@ -54,7 +50,7 @@ class Client:
 
     def connect_on_disconnect(self, callback):
         def _callback(event):
-            idle_add(callback, event)
+            self.dispatcher.dispatch(callback, event)
         self.hangups_client.on_disconnect.add_observer(_callback)
         return _callback
 
@@ -63,7 +59,7 @@ class Client:
 
     def connect_on_state_update(self, callback):
         def _callback(event):
-            idle_add(callback, event)
+            self.dispatcher.dispatch(callback, event)
         self.hangups_client.on_state_update.add_observer(_callback)
         return _callback
 
@@ -71,21 +67,17 @@ class Client:
         self.hangups_client.on_state_update.remove_observer(callback)
 
     def disconnect(self):
-        print("add disconnect to queue")
-        self.queue.continue_queue = False
-        self.loop.call_soon_threadsafe(lambda: self.queue.put_nowait(self.hangups_client.disconnect()))
-        #asyncio.run_coroutine_threadsafe(self.hangups_client.disconnect(), self.loop)
+        print("schedule disconnect")
+        # running sends, uploads and read states finish before the
+        # connection goes, then the hangups thread ends
+        self.scheduler.close(self.hangups_client.disconnect())
 
     def set_active(self):
-        # async def async_set_active():
-        #     await self.hangups_client.set_active()
-        # self.loop.call_soon_threadsafe(self.queue.put_nowait(lambda: async_set_active()))
-        self.loop.call_soon_threadsafe(lambda: self.queue.put_nowait(self.hangups_client.set_active()))
-        #asyncio.run_coroutine_threadsafe(self.hangups_client.set_active(), self.loop)
-
-    def upload_image(self, callback, image_file, filename=None, return_uploaded_image=True):
-        async def async_upload_image(callback, image_file, filename, return_uploaded_image):
-            uploaded_image = await self.hangups_client.upload_image(image_file, filename, return_uploaded_image)
-            idle_add(callback, uploaded_image)
-
-        self.loop.call_soon_threadsafe(lambda: self.queue.put_nowait(async_upload_image(callback, image_file, filename, return_uploaded_image)))
+        return self.scheduler.schedule(self.hangups_client.set_active())
+
+    def upload_image(self, callback, image_file, filename=None, return_uploaded_image=True, error_callback=None):
+        return self.scheduler.schedule(
+            self.hangups_client.upload_image(image_file, filename, return_uploaded_image),
+            callback=callback,
+            error_callback=error_callback
+        )
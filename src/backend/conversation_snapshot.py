@@ -0,0 +1,95 @@
+# This file is part of Hangouts GTK
+# Copyright © 2019-2020 Dominik Schütz <do.sch.dev@gmail.com>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import json
+
+from gi.repository import GLib
+from hangups.conversation_event import ChatMessageEvent
+
+from ..backend.disk_cache import get_cache_dir
+from ..backend.markup import render_markup
+
+
+def get_conversation_name(conversation):
+    if conversation.name:
+        return conversation.name
+
+    others = [u for u in conversation.users if not u.is_self]
+    if len(others) > 1:
+        return ", ".join(u.first_name for u in others)
+    return ", ".join(u.full_name for u in others)
+
+
+def get_message_markup(conversation, event):
+    # preview of event as shown in the sidebar or None
+    if not isinstance(event, ChatMessageEvent):
+        return None
+    return "".join((
+        GLib.markup_escape_text(conversation.get_user(event.user_id).first_name),
+        ": ",
+        render_markup(event, links=False)
+    ))
+
+
+def snapshot_entry(conversation):
+    # everything the sidebar shows of conversation, as plain json data
+    last_message = None
+    for event in reversed(conversation.events):
+        last_message = get_message_markup(conversation, event)
+        if last_message is not None:
+            break
+
+    return {
+        "id": conversation.id_,
+        "name": get_conversation_name(conversation),
+        "participants": [u.full_name for u in conversation.users if not u.is_self],
+        "last_message_markup": last_message,
+        "last_modified": conversation.last_modified.timestamp(),
+        "unread": any(isinstance(e, ChatMessageEvent) for e in conversation.unread_events),
+        "avatars": [u.photo_url for u in conversation.users if not u.is_self and u.photo_url]
+    }
+
+
+class ConversationSnapshot:
+
+    # conversation list as it was on last shutdown, lets the sidebar show
+    # up before hangups is connected
+    def __init__(self, path=None):
+        self.__path = path or os.path.join(get_cache_dir(), "conversations.json")
+
+
+    def load(self):
+        try:
+            with open(self.__path, "r") as snapshot_file:
+                return json.load(snapshot_file)
+        except (OSError, ValueError):
+            return list()
+
+
+    def save(self, conversations):
+        data = json.dumps([snapshot_entry(c) for c in conversations])
+        try:
+            GLib.file_set_contents(self.__path, data.encode("utf-8"))
+        except GLib.Error as e:
+            print("ConversationSnapshot: could not write snapshot: ", e)
+
+
+    def clear(self):
+        try:
+            os.remove(self.__path)
+        except OSError:
+            pass
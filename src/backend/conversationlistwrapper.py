@@ -17,9 +17,6 @@
 #
 # SPDX-License-Identifier: GPL-3.0-or-later
 
-import asyncio
-
-from gi.repository.GLib import idle_add
 from hangups.conversation import ConversationList as HangupsConversationList
 
 from ..backend.conversationwrapper import Conversation
@@ -29,28 +26,39 @@ from ..backend.conversationwrapper import Conversation
 class ConversationList(HangupsConversationList):
 
     hangups_conversation_list = NotImplemented
-    loop = NotImplemented
-    queue = NotImplemented
+    scheduler = NotImplemented
+    event_store = NotImplemented
+    dispatcher = NotImplemented
+    user_directory = NotImplemented
 
     __conversations_cache = dict()
 
-    def __init__(self, hangups_conversation_list, queue):
+    def __init__(self, hangups_conversation_list, scheduler, event_store, dispatcher, user_directory):
         self.hangups_conversation_list = hangups_conversation_list
-        self.queue = queue
-        self.loop = asyncio.get_running_loop()
+        self.scheduler = scheduler
+        self.event_store = event_store
+        self.dispatcher = dispatcher
+        self.user_directory = user_directory
+
+    def get_user_directory(self):
+        return self.user_directory
 
     def connect_on_event(self, callback):
         def _callback(conv_event):
-            idle_add(callback, conv_event)
-        self.hangups_conversation_list.on_connect.add_observer(_callback)
+            self.dispatcher.dispatch(callback, conv_event)
+        self.hangups_conversation_list.on_event.add_observer(_callback)
         return _callback
 
     def disconnect_on_event(self, callback):
-        self.hangups_conversation_list.on_connect.remove_observer(callback)
+        self.hangups_conversation_list.on_event.remove_observer(callback)
 
     def connect_on_typing(self, callback):
         def _callback(typing_message):
-            idle_add(callback, typing_message)
+            # only the latest typing state of a user per conversation matters
+            self.dispatcher.dispatch(
+                callback, typing_message,
+                key=(_callback, typing_message.conv_id, typing_message.user_id)
+            )
         self.hangups_conversation_list.on_typing.add_observer(_callback)
         return _callback
 
@@ -59,7 +67,10 @@ class ConversationList(HangupsConversationList):
 
     def connect_on_watermark_notification(self, callback):
         def _callback(watermark_notification):
-            idle_add(callback, watermark_notification)
+            self.dispatcher.dispatch(
+                callback, watermark_notification,
+                key=(_callback, watermark_notification.conv_id, watermark_notification.user_id)
+            )
         self.hangups_conversation_list.on_watermark_notification.add_observer(_callback)
         return _callback
 
@@ -73,8 +84,10 @@ class ConversationList(HangupsConversationList):
             if not conv.id_ in self.__conversations_cache:
                 wrapper_conv = Conversation(
                     conv,
-                    self.queue,
-                    self.loop
+                    self.scheduler,
+                    self.event_store,
+                    self.dispatcher,
+                    self.user_directory
                 )
                 self.__conversations_cache[conv.id_] = wrapper_conv
             else:
@@ -87,14 +100,33 @@ class ConversationList(HangupsConversationList):
         if conv is None:
             try:
                 conv = Conversation(
-                    self.hangups_conversation_list.get(conf_id),
-                    self.queue,
-                    self.loop
+                    self.hangups_conversation_list.get(conv_id),
+                    self.scheduler,
+                    self.event_store,
+                    self.dispatcher,
+                    self.user_directory
                 )
                 self.__conversations_cache[conv_id] = conv
             except KeyError:
                 raise
         return conv
 
+    def replay_outbox(self):
+        # sends what is left in the outbox, in order of sending
+        for entry in self.event_store.get_outgoing():
+            try:
+                conversation = self.get(entry["conversation_id"])
+            except KeyError:
+                self.event_store.remove_outgoing(entry["client_generated_id"])
+                continue
+            conversation.replay_message(entry)
+
+    def search(self, query, conversation_id=None, limit=50):
+        # ranked (conversation_id, event_id) of stored messages matching query
+        return self.event_store.search(query, conversation_id, limit)
+
     def leave_conversation(self, conf_id):
-        self.loop.call_soon_threadsafe(lambda: self.queue.put_nowait(self.hangups_conversation_list.leave_conversation(conf_id)))
+        return self.scheduler.schedule(
+            self.hangups_conversation_list.leave_conversation(conf_id),
+            key=conf_id
+        )
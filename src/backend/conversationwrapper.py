@@ -18,27 +18,64 @@
 # SPDX-License-Identifier: GPL-3.0-or-later
 
 import asyncio
+import datetime
+from bisect import bisect_left, bisect_right
 
-from gi.repository.GLib import idle_add
+from hangups import NetworkError, hangouts_pb2
 from hangups.conversation import Conversation as HangupsConversation
+from hangups.conversation_event import MembershipChangeEvent
+
+from ..backend.outgoing_message import OutgoingMessage, PENDING, SENT, FAILED
+
+# attempts to send a message before it is marked as failed
+SEND_ATTEMPTS = 4
+# seconds to wait after the first failed attempt, doubled on every attempt
+SEND_BACKOFF = 1
+# newest events of the server searched for a replayed message before it
+# is sent again
+REPLAY_CHECK_EVENTS = 20
+# server events of a replayed message may be older than its local timestamp
+REPLAY_CLOCK_SKEW = datetime.timedelta(minutes=10)
 
 # Thread communication wrapper for Conversation
 class Conversation(HangupsConversation):
 
     hangups_conversation = NotImplemented
-    queue = NotImplemented
-    loop = NotImplemented
+    scheduler = NotImplemented
+    event_store = NotImplemented
+    dispatcher = NotImplemented
+    user_directory = NotImplemented
 
-    def __init__(self, hangups_conversation, queue, loop):
+    def __init__(self, hangups_conversation, scheduler, event_store, dispatcher, user_directory):
         self.__dict__ = hangups_conversation.__dict__
         self.hangups_conversation = hangups_conversation
-        self.queue = queue
-        self.loop = loop
+        self.scheduler = scheduler
+        self.event_store = event_store
+        self.dispatcher = dispatcher
+        self.user_directory = user_directory
+        self.__running_get_events = dict()
+        # True once server history reached events stored by an earlier
+        # session, older stored events are complete from then on
+        self.__history_reconciled = False
+
+        # str(client_generated_id) -> OutgoingMessage without server event
+        self.__outgoing = dict()
+        self.hangups_conversation.on_event.add_observer(self.__on_hangups_event)
+
+        # indexes of users and loaded events, only used in the main loop
+        # user_id -> User of participants, built on first use
+        self.__users = None
+        # events and their timestamps sorted oldest to newest
+        self.__events = list()
+        self.__timestamps = list()
+        # event_id -> position in __events
+        self.__positions = dict()
+        self.__index_events(self.hangups_conversation.events)
 
     def connect_on_event(self, callback):
         def _callback(conv_event):
             print("Conversation.connect_on_event_callback")
-            idle_add(callback, conv_event)
+            self.dispatcher.dispatch(callback, conv_event)
         self.hangups_conversation.on_event.add_observer(_callback)
         return _callback
 
@@ -47,7 +84,11 @@ class Conversation(HangupsConversation):
 
     def connect_on_typing(self, callback):
         def _callback(typing_message):
-            idle_add(callback, typing_message)
+            # only the latest typing state of a user matters
+            self.dispatcher.dispatch(
+                callback, typing_message,
+                key=(_callback, typing_message.user_id)
+            )
         self.hangups_conversation.on_typing.add_observer(_callback)
         return _callback
 
@@ -56,7 +97,10 @@ class Conversation(HangupsConversation):
 
     def connect_on_watermark_notification(self, callback):
         def _callback(watermark_notification):
-            idle_add(callback, watermark_notification)
+            self.dispatcher.dispatch(
+                callback, watermark_notification,
+                key=(_callback, watermark_notification.user_id)
+            )
         self.hangups_conversation.on_watermark_notification.add_observer(_callback)
         return _callback
 
@@ -97,36 +141,289 @@ class Conversation(HangupsConversation):
         return self.hangups_conversation.is_off_the_record
 
     def get_user(self, user_id):
-        return self.hangups_conversation.get_user(user_id)
-
-    def send_message(self, segments, image_file=None):
-        self.loop.call_soon_threadsafe(lambda: self.queue.put_nowait(self.hangups_conversation.send_message(segments, image_file)))
+        user = self.__get_users().get(user_id, None)
+        if user is None:
+            # former participants are fetched by the UserDirectory, until
+            # then hangups makes up a placeholder
+            user = self.user_directory.get_user(user_id) \
+                or self.hangups_conversation.get_user(user_id)
+        return user
+
+    def get_self_user(self):
+        return next(filter(lambda u: u.is_self, self.__get_users().values()), None)
+
+    def __get_users(self):
+        if self.__users is None:
+            self.__users = {user.id_: user for user in self.hangups_conversation.users}
+        return self.__users
+
+    def __index_events(self, events):
+        first_changed = len(self.__events)
+        for event in events:
+            if event.id_ in self.__positions:
+                continue
+            position = bisect_right(self.__timestamps, event.timestamp)
+            self.__events.insert(position, event)
+            self.__timestamps.insert(position, event.timestamp)
+            self.__positions[event.id_] = position
+            first_changed = min(first_changed, position)
+
+            # participants changed
+            if isinstance(event, MembershipChangeEvent):
+                self.__users = None
+
+        # events behind an inserted one moved
+        for position in range(first_changed, len(self.__events)):
+            self.__positions[self.__events[position].id_] = position
+
+    def get_first_event(self):
+        # oldest loaded event or None
+        return self.__events[0] if self.__events else None
+
+    def get_event_position(self, event_id):
+        # position among loaded events, oldest first, or None
+        return self.__positions.get(event_id, None)
+
+    def get_events_between(self, start=None, end=None):
+        # loaded events with start <= timestamp < end, oldest first
+        first = bisect_left(self.__timestamps, start) if start is not None else 0
+        last = bisect_left(self.__timestamps, end) if end is not None else len(self.__events)
+        return self.__events[first:last]
+
+    def send_message(self, segments, image_file=None, image_path=None):
+        # returns OutgoingMessage which reports progress of sending, the
+        # message stays in the outbox until the server confirmed it
+        message = OutgoingMessage(
+            self.hangups_conversation.id_,
+            self.get_self_user().id_,
+            segments,
+            image_file,
+            image_path
+        )
+        self.__outgoing[str(message.client_generated_id)] = message
+        # an opened file does not survive a restart, such a message gets
+        # into the outbox once its image is uploaded
+        if image_file is None or image_path is not None:
+            self.event_store.store_outgoing(message)
+        self.__send(message)
+        return message
+
+    def replay_message(self, entry):
+        # entry of the outbox, sent again after startup or reconnect unless
+        # it is on its way or the server already has it
+        message = self.__outgoing.get(str(entry["client_generated_id"]), None)
+        if message is None:
+            message = OutgoingMessage(
+                self.hangups_conversation.id_,
+                self.get_self_user().id_,
+                entry["segments"],
+                image_path=entry["image_path"],
+                client_generated_id=entry["client_generated_id"],
+                timestamp=entry["timestamp"]
+            )
+            message.image_id = entry["image_id"]
+            self.__outgoing[str(message.client_generated_id)] = message
+        elif message.state in (PENDING, SENT):
+            # on its way or accepted by the server, its event follows
+            return
+
+        client_generated_id = str(message.client_generated_id)
+        for event in reversed(self.__events):
+            if event._event.self_event_state.client_generated_id == client_generated_id:
+                self.__confirmed(message, event)
+                return
+
+        # events synced after a reconnect and of earlier sessions
+        event = self.event_store.get_sent_event(
+            self.hangups_conversation.id_,
+            client_generated_id,
+            message.timestamp - REPLAY_CLOCK_SKEW
+        )
+        if event is not None:
+            self.__confirmed(message, event)
+            return
+
+        message.set_pending()
+        self.__send(message, replayed=True)
+
+    def get_outgoing_messages(self):
+        # messages without event of the server, oldest first
+        return sorted(self.__outgoing.values(), key=lambda m: m.timestamp)
+
+    def retry_message(self, message):
+        if message.state == FAILED:
+            message.set_pending()
+            self.__send(message)
+
+    # changes of a conversation keep their order, other conversations and
+    # requests are not blocked by them
+    def __send(self, message, replayed=False):
+        async def async_send():
+            if replayed:
+                # the server may have the message without us having seen
+                # its event, then its event counts as the response
+                event = await self.__find_sent_event(message)
+                if event is not None:
+                    return hangouts_pb2.SendChatMessageResponse(created_event=event)
+            for attempt in range(SEND_ATTEMPTS):
+                try:
+                    return await self.__send_chat_message(message)
+                except NetworkError as e:
+                    print("Conversation.send_message: ", e)
+                    if attempt == SEND_ATTEMPTS - 1:
+                        raise
+                    await asyncio.sleep(SEND_BACKOFF * 2 ** attempt)
+
+        def sent(response):
+            if response.HasField("created_event"):
+                self.__confirmed(message, HangupsConversation._wrap_event(response.created_event))
+            else:
+                message.set_sent()
+
+        self.scheduler.schedule(
+            async_send(),
+            key=self.hangups_conversation.id_,
+            callback=sent,
+            error_callback=message.set_failed
+        )
+
+    async def __find_sent_event(self, message):
+        # hangouts_pb2.Event of message among the newest events of the
+        # server or None
+        client = self.hangups_conversation._client
+        response = await client.get_conversation(
+            hangouts_pb2.GetConversationRequest(
+                request_header=client.get_request_header(),
+                conversation_spec=hangouts_pb2.ConversationSpec(
+                    conversation_id=hangouts_pb2.ConversationId(
+                        id=self.hangups_conversation.id_
+                    )
+                ),
+                include_event=True,
+                max_events_per_conversation=REPLAY_CHECK_EVENTS
+            )
+        )
+        client_generated_id = str(message.client_generated_id)
+        for event in response.conversation_state.event:
+            if event.self_event_state.client_generated_id == client_generated_id:
+                return event
+        return None
+
+    async def __send_chat_message(self, message):
+        # like hangups' send_message, but with our client_generated_id, so
+        # retries are recognized and the server's event can be matched
+        client = self.hangups_conversation._client
+        if message.image_id is None and (message.image_file or message.image_path):
+            if message.image_path:
+                with open(message.image_path, "rb") as image_file:
+                    uploaded_image = await client.upload_image(
+                        image_file, return_uploaded_image=True
+                    )
+            else:
+                message.image_file.seek(0)
+                uploaded_image = await client.upload_image(
+                    message.image_file, return_uploaded_image=True
+                )
+            message.image_id = uploaded_image.image_id
+            self.event_store.store_outgoing(message)
+
+        request = hangouts_pb2.SendChatMessageRequest(
+            request_header=client.get_request_header(),
+            event_request_header=self.hangups_conversation._get_event_request_header(),
+            message_content=hangouts_pb2.MessageContent(
+                segment=[seg.serialize() for seg in message.segments],
+            ),
+        )
+        request.event_request_header.client_generated_id = message.client_generated_id
+        if message.image_id is not None:
+            request.existing_media.photo.photo_id = message.image_id
+        return await client.send_chat_message(request)
+
+    def __on_hangups_event(self, event):
+        # called in hangups thread, observer was added before the ones of
+        # widgets, so indexes are up to date when their callbacks run
+        self.dispatcher.dispatch(self.__got_event, event)
+
+    def __got_event(self, event):
+        self.__index_events([event])
+
+        client_generated_id = event._event.self_event_state.client_generated_id
+        message = self.__outgoing.get(client_generated_id, None) if client_generated_id else None
+        if message:
+            self.__confirmed(message, event)
+
+    def __confirmed(self, message, event):
+        self.__outgoing.pop(str(message.client_generated_id), None)
+        self.event_store.remove_outgoing(message.client_generated_id)
+        message.set_sent(event)
 
     def leave(self):
-        self.loop.call_soon_threadsafe(lambda: self.queue.put_nowait(self.hangups_conversation.leave()))
+        return self.scheduler.schedule(self.hangups_conversation.leave(), key=self.hangups_conversation.id_)
 
     def rename(self, name):
-        self.loop.call_soon_threadsafe(lambda: self.queue.put_nowait(self.hangups_conversation.rename(name)))
+        return self.scheduler.schedule(self.hangups_conversation.rename(name), key=self.hangups_conversation.id_)
 
     def set_notification_level(self, level):
-        self.loop.call_soon_threadsafe(lambda: self.queue.put_nowait(self.hangups_conversation.set_notification_level(level)))
+        return self.scheduler.schedule(self.hangups_conversation.set_notification_level(level), key=self.hangups_conversation.id_)
 
     def set_typing(self, typing=1):
-        self.loop.call_soon_threadsafe(lambda: self.queue.put_nowait(self.hangups_conversation.set_typing(typing)))
+        return self.scheduler.schedule(self.hangups_conversation.set_typing(typing), key=("typing", self.hangups_conversation.id_))
 
     def update_read_timestamp(self, read_timestamp=None):
-        self.loop.call_soon_threadsafe(lambda: self.queue.put_nowait(self.hangups_conversation.update_read_timestamp(read_timestamp)))
+        return self.scheduler.schedule(self.hangups_conversation.update_read_timestamp(read_timestamp), key=("read", self.hangups_conversation.id_))
 
     def get_events(self, callback, event_id=None, max_events=50):
-        async def async_get_events(cb, event_id, max_events):
+        # only one request per position in history, later callers are
+        # served by the running request
+        key = (event_id, max_events)
+        callbacks = self.__running_get_events.get(key, None)
+        if callbacks is not None:
+            callbacks.append(callback)
+            return
+        self.__running_get_events[key] = [callback]
+
+        async def async_get_events(event_id, max_events):
             events = await self.hangups_conversation.get_events(event_id, max_events)
-
-            idle_add(callback, events)
-
-        self.loop.call_soon_threadsafe(lambda: self.queue.put_nowait(async_get_events(callback, event_id, max_events)))
+            known = self.event_store.has_events(event.id_ for event in events)
+            self.event_store.store_events(events)
+            return events, known
+
+        def failed(error):
+            print("Conversation.get_events: ", error)
+            self.__got_events(key, None)
+
+        self.scheduler.schedule(
+            async_get_events(event_id, max_events),
+            callback=lambda result: self.__got_events(key, *result),
+            error_callback=failed
+        )
+
+    def __got_events(self, key, events, known=False):
+        if events:
+            self.__index_events(events)
+        # an empty page is the start of the conversation
+        if known or events == []:
+            self.__history_reconciled = True
+        for callback in self.__running_get_events.pop(key):
+            callback(events)
+
+    def is_history_reconciled(self):
+        # cached events older than the loaded ones have no gap to them
+        return self.__history_reconciled
+
+    def get_cached_events(self, before_event=None, max_events=50, since_event=None):
+        # events from local EventStore, available without asking the server
+        return self.event_store.get_events(self.hangups_conversation.id_, before_event, max_events, since_event)
+
+    def get_cached_event(self, event_id):
+        return self.event_store.get_event(event_id)
 
     def next_event(self, event_id, prev=False):
-        return self.hangups_conversation.next_event(event_id, prev)
+        # raises KeyError for unknown events like hangups
+        position = self.__positions[event_id] + (-1 if prev else 1)
+        if 0 <= position < len(self.__events):
+            return self.__events[position]
+        return None
 
     def get_event(self, event_id):
-        return self.hangups_conversation.get_event(event_id)
+        return self.__events[self.__positions[event_id]]
@@ -0,0 +1,250 @@
+# This file is part of Hangouts GTK
+# Copyright © 2019-2020 Dominik Schütz <do.sch.dev@gmail.com>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import json
+import time
+import shutil
+import hashlib
+import _thread
+from collections import OrderedDict
+
+from gi.repository import GLib
+
+DISK_CACHE_SIZE = 256 * 1024 * 1024
+DISK_CACHE_MAX_AGE = 7 * 24 * 60 * 60
+# seconds changes of the index are collected before it is written
+INDEX_SAVE_DELAY = 5
+
+
+def get_cache_dir(*subdirs):
+    directory = os.path.join(GLib.get_user_cache_dir(), "hangouts-gtk", *subdirs)
+    os.makedirs(directory, exist_ok=True)
+    return directory
+
+
+class DiskCache:
+
+    # URL keyed cache below $XDG_CACHE_HOME/hangouts-gtk, every entry is
+    # stored as <sha1 of url> and tracked in index.json
+    def __init__(self, directory=None, max_size=DISK_CACHE_SIZE, max_age=DISK_CACHE_MAX_AGE):
+        self.__directory = directory or get_cache_dir("images")
+        self.__index_path = os.path.join(self.__directory, "index.json")
+        self.__max_size = max_size
+        self.__max_age = max_age
+
+        self.__lock = _thread.allocate_lock()
+        # key -> {"url", "size", "etag", "last_modified", "checked"}
+        # ordered from least to most recently used
+        self.__entries = OrderedDict()
+        self.__size = 0
+        self.__dirty = False
+        self.__save_source = None
+
+        self.__load_index()
+
+
+    def __load_index(self):
+        try:
+            with open(self.__index_path, "r") as index_file:
+                entries = json.load(index_file)
+        except (OSError, ValueError):
+            entries = list()
+
+        for key, entry in entries:
+            if os.path.exists(self.__path(key)):
+                self.__entries[key] = entry
+                self.__size += entry["size"]
+
+
+    def __save_index(self):
+        with self.__lock:
+            if not self.__dirty:
+                return
+            data = json.dumps(list(self.__entries.items()))
+            self.__dirty = False
+
+        # written without lock, workers keep going meanwhile
+        try:
+            GLib.file_set_contents(self.__index_path, data.encode("utf-8"))
+        except GLib.Error as e:
+            print("DiskCache: could not write index: ", e)
+            with self.__lock:
+                self.__dirty = True
+
+
+    def __schedule_save(self):
+        # caller needs to hold lock, many entries share one write
+        if self.__save_source is None:
+            self.__save_source = GLib.timeout_add_seconds(INDEX_SAVE_DELAY, self.__save_timeout)
+
+
+    def __save_timeout(self):
+        with self.__lock:
+            self.__save_source = None
+        self.__save_index()
+        return False
+
+
+    @staticmethod
+    def __key(url):
+        return hashlib.sha1(url.encode("utf-8")).hexdigest()
+
+
+    def __path(self, key):
+        return os.path.join(self.__directory, key[:2], key)
+
+
+    def __remove(self, key):
+        # caller needs to hold lock
+        entry = self.__entries.pop(key)
+        self.__size -= entry["size"]
+        self.__dirty = True
+        try:
+            os.remove(self.__path(key))
+        except OSError:
+            pass
+
+
+    def __evict(self):
+        # caller needs to hold lock, drops least recently used entries
+        while self.__size > self.__max_size and self.__entries:
+            self.__remove(next(iter(self.__entries)))
+
+
+    def lookup(self, url):
+        with self.__lock:
+            entry = self.__entries.get(self.__key(url), None)
+            return dict(entry) if entry else None
+
+
+    def is_fresh(self, entry):
+        return time.time() - entry["checked"] < self.__max_age
+
+
+    def validators(self, url):
+        # headers for a conditional request against a cached entry
+        entry = self.lookup(url)
+        headers = dict()
+        if entry:
+            if entry["etag"]:
+                headers["If-None-Match"] = entry["etag"]
+            if entry["last_modified"]:
+                headers["If-Modified-Since"] = entry["last_modified"]
+        return headers
+
+
+    def open(self, url):
+        # returns opened cache file or None, marks entry as used
+        key = self.__key(url)
+        with self.__lock:
+            if key not in self.__entries:
+                return None
+            self.__entries.move_to_end(key)
+            self.__dirty = True
+
+        try:
+            return open(self.__path(key), "rb")
+        except OSError:
+            with self.__lock:
+                if key in self.__entries:
+                    self.__remove(key)
+            return None
+
+
+    def get(self, url):
+        cache_file = self.open(url)
+        if cache_file is None:
+            return None
+        with cache_file:
+            return cache_file.read()
+
+
+    def revalidated(self, url):
+        # server answered 304, entry is fresh again
+        key = self.__key(url)
+        with self.__lock:
+            entry = self.__entries.get(key, None)
+            if entry:
+                entry["checked"] = time.time()
+                self.__entries.move_to_end(key)
+                self.__dirty = True
+                self.__schedule_save()
+
+
+    def __add(self, key, url, size, etag, last_modified):
+        with self.__lock:
+            old = self.__entries.pop(key, None)
+            if old:
+                self.__size -= old["size"]
+            self.__entries[key] = {
+                "url": url,
+                "size": size,
+                "etag": etag,
+                "last_modified": last_modified,
+                "checked": time.time()
+            }
+            self.__size += size
+            self.__dirty = True
+            self.__evict()
+            self.__schedule_save()
+
+
+    def put(self, url, data, etag=None, last_modified=None):
+        key = self.__key(url)
+        path = self.__path(key)
+
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            GLib.file_set_contents(path, data)
+        except (OSError, GLib.Error) as e:
+            print("DiskCache: could not write entry: ", e)
+            return
+
+        self.__add(key, url, len(data), etag, last_modified)
+
+
+    def put_file(self, url, source, etag=None, last_modified=None):
+        # copies an already downloaded file into the cache
+        size = os.path.getsize(source)
+        if size > self.__max_size / 8:
+            return
+
+        key = self.__key(url)
+        path = self.__path(key)
+
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            shutil.copyfile(source, path + ".part")
+            os.replace(path + ".part", path)
+        except OSError as e:
+            print("DiskCache: could not write entry: ", e)
+            return
+
+        self.__add(key, url, size, etag, last_modified)
+
+
+    def flush(self):
+        # called from the main loop, writes pending changes now
+        with self.__lock:
+            if self.__save_source is not None:
+                GLib.source_remove(self.__save_source)
+                self.__save_source = None
+        self.__save_index()
+
+
+    def get_size(self):
+        return self.__size
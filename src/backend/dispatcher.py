@@ -0,0 +1,70 @@
+# dispatcher.py
+#
+# Copyright 2020 Dominik Schütz <do.sch.dev@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+import _thread
+import itertools
+import traceback
+from collections import OrderedDict
+
+from gi.repository import GLib
+
+# calls are drained about once per frame
+DISPATCH_INTERVAL = 16
+
+
+# Hands calls from the hangups thread to the main loop. Everything queued
+# within one interval is run by a single source, a call with the key of a
+# queued call replaces it.
+class Dispatcher:
+
+    def __init__(self, interval=DISPATCH_INTERVAL):
+        self.__interval = interval
+        self.__lock = _thread.allocate_lock()
+        # key -> (callback, args), in order of dispatch
+        self.__calls = OrderedDict()
+        self.__counter = itertools.count()
+        self.__scheduled = False
+
+    def dispatch(self, callback, *args, key=None):
+        with self.__lock:
+            if key is None:
+                key = next(self.__counter)
+            else:
+                # superseded call is dropped, the new one runs in order
+                self.__calls.pop(key, None)
+            self.__calls[key] = (callback, args)
+
+            if self.__scheduled:
+                return
+            self.__scheduled = True
+        GLib.timeout_add(self.__interval, self.__drain)
+
+    def __drain(self):
+        with self.__lock:
+            calls = self.__calls
+            self.__calls = OrderedDict()
+            self.__scheduled = False
+
+        for callback, args in calls.values():
+            try:
+                callback(*args)
+            except Exception:
+                traceback.print_exc()
+
+        return False
@@ -0,0 +1,344 @@
+# This file is part of Hangouts GTK
+# Copyright © 2019-2020 Dominik Schütz <do.sch.dev@gmail.com>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import re
+import json
+import datetime
+import sqlite3
+import _thread
+
+from gi.repository import GLib
+from hangups import hangouts_pb2, ChatMessageSegment
+from hangups.conversation_event import ChatMessageEvent
+from hangups.user import User, UserID
+from hangups.conversation import Conversation as HangupsConversation
+
+
+def get_data_dir(*subdirs):
+    directory = os.path.join(GLib.get_user_data_dir(), "hangouts-gtk", *subdirs)
+    os.makedirs(directory, exist_ok=True)
+    return directory
+
+
+class EventStore:
+
+    # local copy of conversation events and users, written from the hangups
+    # thread and read from the main loop
+    def __init__(self, path=None):
+        self.__path = path or os.path.join(get_data_dir(), "history.db")
+        self.__lock = _thread.allocate_lock()
+        self.__connection = sqlite3.connect(self.__path, check_same_thread=False)
+
+        with self.__lock, self.__connection as connection:
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS events ("
+                "event_id TEXT PRIMARY KEY, "
+                "conversation_id TEXT NOT NULL, "
+                "timestamp INTEGER NOT NULL, "
+                "data BLOB NOT NULL)"
+            )
+            connection.execute(
+                "CREATE INDEX IF NOT EXISTS events_by_conversation "
+                "ON events (conversation_id, timestamp)"
+            )
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS users ("
+                "chat_id TEXT PRIMARY KEY, "
+                "gaia_id TEXT, "
+                "full_name TEXT, "
+                "first_name TEXT, "
+                "photo_url TEXT, "
+                "emails TEXT, "
+                "is_self INTEGER)"
+            )
+
+            # messages not confirmed by the server yet
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS outbox ("
+                "client_generated_id TEXT PRIMARY KEY, "
+                "conversation_id TEXT NOT NULL, "
+                "timestamp REAL NOT NULL, "
+                "segments BLOB NOT NULL, "
+                "image_path TEXT, "
+                "image_id TEXT)"
+            )
+
+            # text of chat messages, rowid is the rowid of the event
+            created = not connection.execute(
+                "SELECT 1 FROM sqlite_master WHERE name = 'messages'"
+            ).fetchone()
+            try:
+                connection.execute(
+                    "CREATE VIRTUAL TABLE IF NOT EXISTS messages "
+                    "USING fts5(text, tokenize='unicode61 remove_diacritics 2')"
+                )
+                self.__full_text = True
+            except sqlite3.OperationalError:
+                # sqlite without fts5, search with LIKE instead
+                connection.execute(
+                    "CREATE TABLE IF NOT EXISTS messages (text TEXT)"
+                )
+                self.__full_text = False
+
+        # index history stored before messages existed
+        if created:
+            self.__reindex()
+
+
+    @staticmethod
+    def __wrap(data):
+        event = hangouts_pb2.Event()
+        event.ParseFromString(data)
+        return HangupsConversation._wrap_event(event)
+
+
+    def __index(self, connection, events):
+        # caller needs to hold lock, events are already stored
+        rows = [
+            (event.text, event.id_) for event in events
+            if isinstance(event, ChatMessageEvent) and event.text
+        ]
+        connection.executemany(
+            "INSERT OR REPLACE INTO messages (rowid, text) "
+            "SELECT rowid, ? FROM events WHERE event_id = ?",
+            rows
+        )
+
+
+    def __reindex(self):
+        with self.__lock, self.__connection as connection:
+            events = [
+                self.__wrap(data) for (data, ) in
+                connection.execute("SELECT data FROM events")
+            ]
+            self.__index(connection, events)
+
+
+    def store_events(self, events):
+        rows = [(
+            event.id_,
+            event.conversation_id,
+            event._event.timestamp,
+            event._event.SerializeToString()
+        ) for event in events]
+
+        if not rows:
+            return
+
+        with self.__lock, self.__connection as connection:
+            # update in place, rowid of an event has to stay the same
+            connection.executemany(
+                "INSERT INTO events VALUES (?, ?, ?, ?) "
+                "ON CONFLICT (event_id) DO UPDATE SET "
+                "timestamp = excluded.timestamp, data = excluded.data",
+                rows
+            )
+            self.__index(connection, events)
+
+
+    def get_events(self, conversation_id, before_event=None, max_events=50, since_event=None):
+        # newest max_events events older than before_event and not older
+        # than since_event, oldest first, max_events None for all of them
+        before = before_event._event.timestamp if before_event else 2 ** 63 - 1
+        since = since_event._event.timestamp if since_event else 0
+        with self.__lock:
+            rows = self.__connection.execute(
+                "SELECT data FROM events "
+                "WHERE conversation_id = ? AND timestamp < ? AND timestamp >= ? "
+                "ORDER BY timestamp DESC LIMIT ?",
+                (conversation_id, before, since, -1 if max_events is None else max_events)
+            ).fetchall()
+
+        return [self.__wrap(data) for (data, ) in reversed(rows)]
+
+
+    def get_event(self, event_id):
+        with self.__lock:
+            row = self.__connection.execute(
+                "SELECT data FROM events WHERE event_id = ?",
+                (event_id, )
+            ).fetchone()
+        return self.__wrap(row[0]) if row else None
+
+
+    def get_sent_event(self, conversation_id, client_generated_id, since):
+        # own event of a message sent with client_generated_id, only events
+        # not older than datetime since are looked at
+        since = int(since.timestamp() * 1000000)
+        with self.__lock:
+            rows = self.__connection.execute(
+                "SELECT data FROM events "
+                "WHERE conversation_id = ? AND timestamp >= ? "
+                "ORDER BY timestamp",
+                (conversation_id, since)
+            ).fetchall()
+
+        for (data, ) in rows:
+            event = hangouts_pb2.Event()
+            event.ParseFromString(data)
+            if event.self_event_state.client_generated_id == str(client_generated_id):
+                return HangupsConversation._wrap_event(event)
+        return None
+
+
+    def has_events(self, event_ids):
+        # True if any of event_ids is stored already
+        event_ids = list(event_ids)
+        if not event_ids:
+            return False
+        with self.__lock:
+            row = self.__connection.execute(
+                "SELECT 1 FROM events WHERE event_id IN ({}) LIMIT 1".format(
+                    ", ".join("?" * len(event_ids))
+                ),
+                event_ids
+            ).fetchone()
+        return row is not None
+
+
+    def search(self, query, conversation_id=None, limit=50):
+        # (conversation_id, event_id) of chat messages matching all words
+        # of query, best match first
+        words = query.split()
+        if not words:
+            return list()
+
+        if self.__full_text:
+            # every word is a quoted prefix, so user input is never syntax
+            match = " ".join(
+                '"{}"*'.format(word.replace('"', '""')) for word in words
+            )
+            sql = "SELECT conversation_id, event_id FROM messages " \
+                "JOIN events ON events.rowid = messages.rowid " \
+                "WHERE messages MATCH ?"
+            parameters = [match]
+            order = "ORDER BY rank"
+        else:
+            sql = "SELECT conversation_id, event_id FROM messages " \
+                "JOIN events ON events.rowid = messages.rowid WHERE " + \
+                " AND ".join(["messages.text LIKE ? ESCAPE '\\'"] * len(words))
+            parameters = [
+                "%{}%".format(re.sub(r"([\\%_])", r"\\\1", word))
+                for word in words
+            ]
+            order = "ORDER BY timestamp DESC"
+
+        if conversation_id:
+            sql += " AND conversation_id = ?"
+            parameters.append(conversation_id)
+
+        with self.__lock:
+            try:
+                return self.__connection.execute(
+                    "{} {} LIMIT ?".format(sql, order),
+                    parameters + [limit]
+                ).fetchall()
+            except sqlite3.OperationalError as e:
+                print("EventStore.search: ", e)
+                return list()
+
+
+    def store_users(self, users):
+        rows = [(
+            user.id_.chat_id,
+            user.id_.gaia_id,
+            user.full_name,
+            user.first_name,
+            user.photo_url,
+            json.dumps(user.emails),
+            user.is_self
+        ) for user in users]
+
+        with self.__lock, self.__connection as connection:
+            connection.executemany(
+                "INSERT OR REPLACE INTO users VALUES (?, ?, ?, ?, ?, ?, ?)",
+                rows
+            )
+
+
+    def get_users(self):
+        with self.__lock:
+            rows = self.__connection.execute("SELECT * FROM users").fetchall()
+
+        return [User(
+            UserID(chat_id=chat_id, gaia_id=gaia_id),
+            full_name,
+            first_name,
+            photo_url,
+            json.loads(emails),
+            bool(is_self)
+        ) for (chat_id, gaia_id, full_name, first_name, photo_url, emails, is_self) in rows]
+
+
+    def store_outgoing(self, message):
+        # adds or updates OutgoingMessage in the outbox
+        segments = hangouts_pb2.MessageContent(
+            segment=[segment.serialize() for segment in message.segments]
+        ).SerializeToString()
+
+        with self.__lock, self.__connection as connection:
+            connection.execute(
+                "INSERT OR REPLACE INTO outbox VALUES (?, ?, ?, ?, ?, ?)",
+                (
+                    str(message.client_generated_id),
+                    message.conversation_id,
+                    message.timestamp.timestamp(),
+                    segments,
+                    message.image_path,
+                    message.image_id
+                )
+            )
+
+
+    def remove_outgoing(self, client_generated_id):
+        with self.__lock, self.__connection as connection:
+            connection.execute(
+                "DELETE FROM outbox WHERE client_generated_id = ?",
+                (str(client_generated_id), )
+            )
+
+
+    def get_outgoing(self):
+        # outbox as dicts of OutgoingMessage arguments, oldest first
+        with self.__lock:
+            rows = self.__connection.execute(
+                "SELECT * FROM outbox ORDER BY timestamp"
+            ).fetchall()
+
+        outgoing = list()
+        for (client_generated_id, conversation_id, timestamp, segments, image_path, image_id) in rows:
+            content = hangouts_pb2.MessageContent()
+            content.ParseFromString(segments)
+            outgoing.append({
+                "client_generated_id": int(client_generated_id),
+                "conversation_id": conversation_id,
+                "timestamp": datetime.datetime.fromtimestamp(timestamp, datetime.timezone.utc),
+                "segments": [ChatMessageSegment.deserialize(s) for s in content.segment],
+                "image_path": image_path,
+                "image_id": image_id
+            })
+        return outgoing
+
+
+    def clear(self):
+        with self.__lock, self.__connection as connection:
+            connection.execute("DELETE FROM events")
+            connection.execute("DELETE FROM messages")
+            connection.execute("DELETE FROM outbox")
+            connection.execute("DELETE FROM users")
@@ -0,0 +1,51 @@
+# This file is part of Hangouts GTK
+# Copyright © 2019-2020 Dominik Schütz <do.sch.dev@gmail.com>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import requests
+from requests.adapters import HTTPAdapter
+
+HTTP_POOL_HOSTS = 4
+HTTP_POOL_CONNECTIONS = 8
+HTTP_RETRIES = 2
+# (connect, read) in seconds
+HTTP_TIMEOUT = (5, 30)
+
+
+class HttpSession:
+
+    # keep-alive session shared by all image downloads, so that connections
+    # to the same host are reused instead of doing a new TLS handshake
+    def __init__(self, pool_hosts=HTTP_POOL_HOSTS, pool_connections=HTTP_POOL_CONNECTIONS,
+                 retries=HTTP_RETRIES, timeout=HTTP_TIMEOUT):
+        self.__timeout = timeout
+        self.__session = requests.Session()
+
+        adapter = HTTPAdapter(
+            pool_connections=pool_hosts,
+            pool_maxsize=pool_connections,
+            max_retries=retries
+        )
+        self.__session.mount("https://", adapter)
+        self.__session.mount("http://", adapter)
+
+
+    def get(self, url, **kwargs):
+        kwargs.setdefault("timeout", self.__timeout)
+        return self.__session.get(url, **kwargs)
+
+
+    def close(self):
+        self.__session.close()
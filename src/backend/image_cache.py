@@ -14,116 +14,482 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import os
+import heapq
 import requests
 import _thread
+from itertools import count
+from queue import PriorityQueue
+from collections import deque, OrderedDict
+from urllib.parse import urlsplit
 from gi.repository import Gio, GLib
-from gi.repository.GdkPixbuf import Pixbuf, InterpType
+from gi.repository.GdkPixbuf import Pixbuf, PixbufLoader, InterpType
+
+from ..backend.disk_cache import DiskCache
+from ..backend.http_session import HttpSession
+from ..backend.pixbuf_cache import PixbufCache
+from ..backend.avatar import avatar_layout, render_avatar, MAX_AVATAR_IMAGES
 
 PROFILE_PHOTO = (46, 46)
 PROFILE_PHOTO_SMALL = (32, 32)
 SENT_IMAGE_PREVIEW = (200, 200)
+# (ANIMATION, size) is used by requests for an animation scaled to size
+# instead of a single pixbuf
+ANIMATION = "animation"
+
+# visible avatars are fetched before message previews and attachments
+PRIORITY_HIGH = 0
+PRIORITY_DEFAULT = 1
+PRIORITY_LOW = 2
+
+FETCH_WORKERS = 6
+FETCH_WORKERS_PER_HOST = 4
+
+IMAGE_CACHE_SIZE = 64 * 1024 * 1024
+SCALED_CACHE_SIZE = 32 * 1024 * 1024
+AVATAR_CACHE_ENTRIES = 512
+SAVE_CHUNK_SIZE = 64 * 1024
+
+
+def normalize_url(url):
+    # hangups gives protocol relative URLs, None stays None
+    if url and not url.startswith("https:"):
+        url = "https:" + url
+    return url
 
 
 class ImageCache:
 
-    # create ImageCache TODO: load cache from .cache directory
-    def __init__(self):
-        self.__raw_image_dict = dict()
-        self.__scaled_image_dict = dict()
+    # create ImageCache, downloaded images are kept in a DiskCache
+    def __init__(self, disk_cache=None, http_session=None, workers=FETCH_WORKERS, workers_per_host=FETCH_WORKERS_PER_HOST,
+                 image_cache_size=IMAGE_CACHE_SIZE, scaled_cache_size=SCALED_CACHE_SIZE):
+        self.__disk_cache = disk_cache or DiskCache()
+        self.__http_session = http_session or HttpSession(pool_connections=workers)
+        # (url, size) -> scaled pixbuf
+        self.__scaled_image_dict = PixbufCache(scaled_cache_size)
+        # (urls, size) -> rendered round avatar surface
+        self.__avatar_dict = OrderedDict()
 
         self.__sem = _thread.allocate_lock()
-        self.__image_dict = dict()
+        # url -> full size pixbuf
+        self.__image_dict = PixbufCache(image_cache_size)
+        # url -> list of (callback, size, cache, cancellable) waiting for that url
         self.__fetching_dict = dict()
 
+        # results are handed to the main loop by one dispatcher
+        self.__results = deque()
+        self.__dispatch_scheduled = False
 
-    def __get_image_thread(self, url: str, callback, cache, userdata=None):
+        # bounded fetch pool
+        self.__jobs = PriorityQueue()
+        self.__job_counter = count()
+        self.__workers_per_host = workers_per_host
+        self.__host_active = dict()
+        self.__host_waiting = dict()
+        for _ in range(workers):
+            _thread.start_new_thread(self.__worker, ())
 
-        # standardize all URLs
-        if not url.startswith("https:"):
-            url = "https:" + url
 
-        # look into cache
-        cached = self.__image_dict.get(url, None)
-        if cached:
-            _thread.start_new_thread(
-                callback, (cached, userdata)
-            )
-            return
+    def __deliver(self, callback, image, cancellable):
+        with self.__sem:
+            self.__results.append((callback, image, cancellable))
+            if self.__dispatch_scheduled:
+                return
+            self.__dispatch_scheduled = True
+        GLib.idle_add(self.__dispatch)
 
-        # no one is allowed to look inside fetching_dict
-        self.__sem.acquire()
 
-        # look into cache again
-        cached = self.__image_dict.get(url, None)
-        if cached:
-            self.__sem.release()
-            callback(cached, userdata)
-            return
+    def __dispatch(self):
+        with self.__sem:
+            results = self.__results
+            self.__results = deque()
+            self.__dispatch_scheduled = False
+
+        for callback, image, cancellable in results:
+            if not cancellable.is_cancelled():
+                callback(image)
+
+        return False
 
-        # see if someone else is working
-        do_the_work = len(self.__fetching_dict) == 0
 
-        work = (callback, userdata, cache)
-        url_list = self.__fetching_dict.get(url, list())
-        url_list.append(work)
-        self.__fetching_dict[url] = url_list
+    def __schedule(self, url, priority):
+        # caller needs to hold sem, respects the per host limit
+        host = urlsplit(url).netloc
+        job = (priority, next(self.__job_counter), url)
+        if self.__host_active.get(host, 0) < self.__workers_per_host:
+            self.__host_active[host] = self.__host_active.get(host, 0) + 1
+            self.__jobs.put(job)
+        else:
+            heapq.heappush(self.__host_waiting.setdefault(host, list()), job)
 
-        self.__sem.release()
 
-        # return if someone else needs to do the work
-        if not do_the_work:
+    def __finished(self, url):
+        # caller needs to hold sem, lets next url of same host run
+        host = urlsplit(url).netloc
+        waiting = self.__host_waiting.get(host, None)
+        if waiting:
+            self.__jobs.put(heapq.heappop(waiting))
+            if not waiting:
+                del self.__host_waiting[host]
+        else:
+            self.__host_active[host] -= 1
+            if not self.__host_active[host]:
+                del self.__host_active[host]
+
+
+    def __worker(self):
+        while True:
+            _, _, url = self.__jobs.get()
+            try:
+                self.__run_job(url)
+            except Exception as e:
+                # worker must survive whatever a single url does
+                print("ImageCache: failed on ", url, e)
+
+
+    def __run_job(self, url):
+        # drop request if everyone waiting has lost interest
+        with self.__sem:
+            waiting = self.__fetching_dict[url]
+            if all(c.is_cancelled() for (_, _, _, c) in waiting):
+                del self.__fetching_dict[url]
+                self.__finished(url)
+                return
+
+        # request image, url is released on every way out
+        data = None
+        try:
+            data = self.__download(url)
+        except Exception as e:
+            print("ImageCache: could not load ", url, e)
+        finally:
+            with self.__sem:
+                self.__finished(url)
+                waiting = self.__fetching_dict.pop(url)
+
+        if data is None:
             return
 
-        # iterate through all urls
-        while len(self.__fetching_dict):
-            # get first key
-            url = next(iter(self.__fetching_dict))
+        # decode straight to every requested size, once per size
+        decoded = dict()
+        for (callback, size, cache, cancellable) in waiting:
+            if cancellable.is_cancelled():
+                continue
+
+            if size not in decoded:
+                decoded[size] = self.__decode(url, data, size, cache)
+
+            # animation requests also learn that there is no animation
+            if decoded[size] is not None or _is_animation(size):
+                self.__deliver(callback, decoded[size], cancellable)
+
+
+    def __decode(self, url, data, size, cache):
+        try:
+            if _is_animation(size):
+                return decode_animation(data, size[1])
+            pixbuf = decode(data, size)
+        except GLib.Error as e:
+            print("ImageCache: could not decode ", url, e)
+            return None
+
+        if size is not None:
+            self.__scaled_image_dict.put((url, size), pixbuf)
+        elif cache:
+            self.__image_dict.put(url, pixbuf)
+        return pixbuf
+
+
+    def __download(self, url):
+        disk_cache = self.__disk_cache
+
+        # look into disk cache first
+        entry = disk_cache.lookup(url)
+        if entry and disk_cache.is_fresh(entry):
+            data = disk_cache.get(url)
+            if data is not None:
+                return data
+
+        # ask server, revalidate stale entry if there is one
+        headers = disk_cache.validators(url) if entry else dict()
+        try:
+            response = self.__http_session.get(url, headers=headers)
+        except requests.RequestException:
+            # offline, stale data is better than nothing
+            data = disk_cache.get(url) if entry else None
+            if data is not None:
+                return data
+            raise
+
+        if response.status_code == 304:
+            data = disk_cache.get(url)
+            if data is not None:
+                disk_cache.revalidated(url)
+                return data
+            response = self.__http_session.get(url)
+
+        data = response.content
+        if response.ok:
+            disk_cache.put(
+                url,
+                data,
+                etag=response.headers.get("ETag", None),
+                last_modified=response.headers.get("Last-Modified", None)
+            )
+        return data
+
+
+    def __scale(self, url, pixbuf, size):
+        scaled = resize(pixbuf, size)
+        self.__scaled_image_dict.put((url, size), scaled)
+        return scaled
+
+
+    def get_stats(self):
+        return {
+            "images": self.__image_dict.get_stats(),
+            "scaled_images": self.__scaled_image_dict.get_stats(),
+            "disk_bytes": self.__disk_cache.get_size()
+        }
+
+
+    def flush(self):
+        self.__disk_cache.flush()
+
+
+    def close(self):
+        self.flush()
+        self.__http_session.close()
+
+
+    # calls callback with the image of url on the main loop, the returned
+    # Gio.Cancellable stops the request if the image is not needed any more
+    def get_image(self, url: str, callback, size=PROFILE_PHOTO, cache=False,
+                  priority=PRIORITY_DEFAULT, cancellable=None):
+        cancellable = cancellable or Gio.Cancellable()
+
+        url = normalize_url(url)
+
+        # look into cache of scaled images
+        scaled = self.__scaled_image_dict.get((url, size))
+        if scaled is not None:
+            self.__deliver(callback, scaled, cancellable)
+            return cancellable
+
+        with self.__sem:
+            # look into cache
+            cached = self.__image_dict.get(url)
+            if cached is None:
+                self.__request(url, callback, size, cache, priority, cancellable)
+                return cancellable
 
-            # request image
-            response = requests.get(url)
-            input_stream = Gio.MemoryInputStream.new_from_data(response.content, None)
-            pixbuf = Pixbuf.new_from_stream(input_stream, None)
-            input_stream.close()
+        self.__deliver(callback, self.__scale(url, cached, size), cancellable)
+        return cancellable
 
-            self.__sem.acquire()
-            # pass image to every callback
-            for (callback, userdata, cache) in self.__fetching_dict.get(url):
-                if cache:
-                    self.__image_dict[url] = pixbuf
-                _thread.start_new_thread(
-                    callback,
-                    (pixbuf, userdata)
-                )
-            del self.__fetching_dict[url]
-            self.__sem.release()
 
+    # calls callback with a PixbufAnimation of url scaled to size or with
+    # None if url is not an animated image, animations are decoded on every
+    # call and not cached
+    def get_animation(self, url: str, callback, size=None, priority=PRIORITY_DEFAULT, cancellable=None):
+        cancellable = cancellable or Gio.Cancellable()
 
-    def get_image(self, url: str, callback, size=PROFILE_PHOTO, cache=False):
+        url = normalize_url(url)
 
-        def got_image(image, userdata):
-            callback, size = userdata
-            resize(image, size, callback)
+        with self.__sem:
+            self.__request(url, callback, (ANIMATION, size), False, priority, cancellable)
+        return cancellable
+
+
+    def __request(self, url, callback, size, cache, priority, cancellable):
+        # caller needs to hold sem, joins running request or starts a new one
+        waiting = self.__fetching_dict.get(url, None)
+        if waiting is None:
+            waiting = self.__fetching_dict[url] = list()
+            self.__schedule(url, priority)
+        waiting.append((callback, size, cache, cancellable))
+
+
+    # writes the original bytes of url to filename without decoding them,
+    # progress_callback gets (written bytes, total bytes or None) and
+    # callback gets None on success or the error
+    def save_image(self, url: str, filename, callback, progress_callback=None, cancellable=None):
+        cancellable = cancellable or Gio.Cancellable()
+
+        url = normalize_url(url)
 
         _thread.start_new_thread(
-            self.__get_image_thread,
-            (url, got_image, cache, (callback, size))
+            self.__save_image_thread,
+            (url, filename, callback, progress_callback, cancellable)
         )
+        return cancellable
 
-def resize(pixbuf, size, callback):
 
-    if size is None:
-        GLib.idle_add(callback, pixbuf)
-        return
+    def __save_image_thread(self, url, filename, callback, progress_callback, cancellable):
+        part = filename + ".part"
+
+        def report(written, total):
+            if progress_callback:
+                self.__deliver(lambda _: progress_callback(written, total), None, cancellable)
+
+        def copy(source, destination, total):
+            written = 0
+            for chunk in iter(lambda: source.read(SAVE_CHUNK_SIZE), b""):
+                if cancellable.is_cancelled():
+                    raise InterruptedError("saving was cancelled")
+                destination.write(chunk)
+                written += len(chunk)
+                report(written, total)
+
+        try:
+            # reuse cached file
+            cache_file = self.__disk_cache.open(url)
+            if cache_file is not None:
+                with cache_file, open(part, "wb") as destination:
+                    total = os.fstat(cache_file.fileno()).st_size
+                    copy(cache_file, destination, total)
+                os.replace(part, filename)
+
+            # stream download into file
+            else:
+                with self.__http_session.get(url, stream=True) as response:
+                    response.raise_for_status()
+                    total = response.headers.get("Content-Length", None)
+                    total = int(total) if total else None
+                    response.raw.decode_content = True
+                    with open(part, "wb") as destination:
+                        copy(response.raw, destination, total)
+                    os.replace(part, filename)
+
+                    self.__disk_cache.put_file(
+                        url,
+                        filename,
+                        etag=response.headers.get("ETag", None),
+                        last_modified=response.headers.get("Last-Modified", None)
+                    )
+
+        except (OSError, requests.RequestException) as e:
+            print("ImageCache: could not save ", url, e)
+            try:
+                os.remove(part)
+            except OSError:
+                pass
+            GLib.idle_add(callback, e)
+            return
+
+        GLib.idle_add(callback, None)
+
+
+    # calls callback with a cairo surface showing the images of urls clipped
+    # to circles, surfaces are rendered once per url set and size
+    def get_avatar(self, urls, callback, size, cancellable=None):
+        cancellable = cancellable or Gio.Cancellable()
+        # users without photo have None, if nobody has one callback is
+        # not called and the widget keeps its placeholder
+        urls = [normalize_url(url) for url in urls if url]
+        key = (tuple(urls[:MAX_AVATAR_IMAGES]), size)
+        if not key[0]:
+            return cancellable
+
+        surface = self.__avatar_dict.get(key, None)
+        if surface is not None:
+            self.__avatar_dict.move_to_end(key)
+            self.__deliver(callback, surface, cancellable)
+            return cancellable
+
+        layout = avatar_layout(len(key[0]), size)
+        pixbufs = [None] * len(key[0])
+
+        def got_image(num, pixbuf):
+            pixbufs[num] = pixbuf
+            if any(p is None for p in pixbufs):
+                return
+
+            surface = self.__avatar_dict.get(key, None)
+            if surface is None:
+                surface = render_avatar(pixbufs, size)
+                self.__avatar_dict[key] = surface
+                if len(self.__avatar_dict) > AVATAR_CACHE_ENTRIES:
+                    self.__avatar_dict.popitem(last=False)
+            callback(surface)
+
+        for num, url in enumerate(key[0]):
+            diameter = 2 * layout[num][2]
+            self.get_image(
+                url,
+                lambda pixbuf, num=num: got_image(num, pixbuf),
+                (diameter, diameter),
+                cache=True,
+                priority=PRIORITY_HIGH,
+                cancellable=cancellable
+            )
 
+        return cancellable
+
+
+def decode(data, size=None):
+    input_stream = Gio.MemoryInputStream.new_from_bytes(GLib.Bytes.new(data))
+    try:
+        if size is None or (size[0] <= 0 and size[1] <= 0):
+            return Pixbuf.new_from_stream(input_stream, None)
+
+        # lets the loader scale while decoding, e.g. jpeg is decoded at a
+        # fraction of its resolution instead of decoding the full image
+        width, height = size
+        return Pixbuf.new_from_stream_at_scale(
+            input_stream,
+            max(1, int(width)) if width > 0 else -1,
+            max(1, int(height)) if height > 0 else -1,
+            True,
+            None
+        )
+    finally:
+        input_stream.close()
+
+
+def _is_animation(size):
+    return isinstance(size, tuple) and size[0] is ANIMATION
+
+
+def decode_animation(data, size=None):
+    # only gif is animated, do not bother the loaders with anything else
+    if not data.startswith(b"GIF8"):
+        return None
+
+    # frames are scaled by the loader, not once per frame when shown
+    loader = PixbufLoader.new_with_type("gif")
+    if size is not None and (size[0] > 0 or size[1] > 0):
+        def size_prepared(loader, width, height):
+            loader.set_size(*fit_size(width, height, size))
+
+        loader.connect("size-prepared", size_prepared)
+
+    try:
+        loader.write(data)
+    finally:
+        loader.close()
+
+    animation = loader.get_animation()
+    return None if animation is None or animation.is_static_image() else animation
+
+
+def fit_size(width, height, size):
+    # width and height scaled to size, keeping the aspect ratio
+    dim = width / height
     width, height = size
-    if width <= 0 and height <= 0:
-        return pixbuf
-    dim = pixbuf.props.width / pixbuf.props.height
     if dim > 1:
         height = width / dim
     else:
         width = height * dim
+    return max(1, int(width)), max(1, int(height))
+
 
-    scaled_image = pixbuf.scale_simple(width, height, InterpType.BILINEAR)
+def resize(pixbuf, size):
+
+    if size is None:
+        return pixbuf
+
+    if size[0] <= 0 and size[1] <= 0:
+        return pixbuf
+    width, height = fit_size(pixbuf.props.width, pixbuf.props.height, size)
 
-    GLib.idle_add(callback, scaled_image)
+    return pixbuf.scale_simple(width, height, InterpType.BILINEAR)
@@ -0,0 +1,97 @@
+# markup.py
+#
+# Copyright 2020 Dominik Schütz <do.sch.dev@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+import itertools
+from collections import OrderedDict
+
+from gi.repository import GLib
+
+MARKUP_CACHE_ENTRIES = 4096
+
+
+def _compile_tags():
+    # (is_bold, is_italic, is_strikethrough, is_underline) -> (opening, closing)
+    names = ("b", "i", "s", "u")
+    tags = dict()
+    for flags in itertools.product((False, True), repeat=len(names)):
+        used = [name for name, flag in zip(names, flags) if flag]
+        tags[flags] = (
+            "".join("<{}>".format(name) for name in reversed(used)),
+            "".join("</{}>".format(name) for name in used)
+        )
+    return tags
+
+
+_TAGS = _compile_tags()
+
+
+def segments_to_markup(segments, links=True):
+    parts = list()
+    for segment in segments:
+        opening, closing = _TAGS[(
+            bool(segment.is_bold),
+            bool(segment.is_italic),
+            bool(segment.is_strikethrough),
+            bool(segment.is_underline)
+        )]
+        link = links and segment.link_target
+        if link:
+            parts.append("<a href=\"")
+            parts.append(GLib.markup_escape_text(segment.link_target))
+            parts.append("\">")
+        parts.append(opening)
+        parts.append(GLib.markup_escape_text(segment.text))
+        parts.append(closing)
+        if link:
+            parts.append("</a>")
+    return "".join(parts)
+
+
+class MarkupCache:
+
+    # markup of event segments by event id, least recently used entries
+    # are dropped
+    def __init__(self, max_entries=MARKUP_CACHE_ENTRIES):
+        self.__max_entries = max_entries
+        self.__entries = OrderedDict()
+
+    def render(self, segments, event_id=None, links=True):
+        if event_id is None:
+            return segments_to_markup(segments, links)
+
+        key = (event_id, links)
+        markup = self.__entries.get(key, None)
+        if markup is not None:
+            self.__entries.move_to_end(key)
+            return markup
+
+        markup = segments_to_markup(segments, links)
+        self.__entries[key] = markup
+        if len(self.__entries) > self.__max_entries:
+            self.__entries.popitem(last=False)
+        return markup
+
+
+# shared by message views and sidebar, only used from the main loop
+_markup_cache = MarkupCache()
+
+
+def render_markup(event, links=True):
+    # markup of a ChatMessageEvent, or anything with segments and id_
+    return _markup_cache.render(event.segments, event.id_, links)
@@ -0,0 +1,76 @@
+# outgoing_message.py
+#
+# Copyright 2020 Dominik Schütz <do.sch.dev@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+import datetime
+
+from gi.repository import GObject
+from hangups import Client as HangupsClient
+
+# states of an OutgoingMessage
+PENDING = "pending"
+SENT = "sent"
+FAILED = "failed"
+
+
+# message sent by Conversation.send_message, known before the server has
+# seen it and matched with the server's event by client_generated_id
+class OutgoingMessage(GObject.Object):
+
+    __gsignals__ = {
+        "state-changed": (GObject.SignalFlags.RUN_FIRST, None, ())
+    }
+
+    def __init__(self, conversation_id, user_id, segments, image_file=None,
+                 image_path=None, client_generated_id=None, timestamp=None):
+        super().__init__()
+        self.client_generated_id = client_generated_id or HangupsClient.get_client_generated_id()
+        self.conversation_id = conversation_id
+        self.segments = segments
+        # image is either an opened file or a path, only paths survive
+        # a restart in the outbox
+        self.image_file = image_file
+        self.image_path = image_path
+        # set when image_file is uploaded, retries do not upload again
+        self.image_id = None
+
+        # looks like a ChatMessageEvent to the message views
+        self.id_ = None
+        self.user_id = user_id
+        self.timestamp = timestamp or datetime.datetime.now(datetime.timezone.utc)
+        self.attachments = list()
+
+        self.state = PENDING
+        self.error = None
+        # ChatMessageEvent of the server, once known
+        self.event = None
+
+    def set_pending(self):
+        self.state = PENDING
+        self.error = None
+        self.emit("state-changed")
+
+    def set_sent(self, event=None):
+        self.state = SENT
+        self.event = event or self.event
+        self.emit("state-changed")
+
+    def set_failed(self, error):
+        self.state = FAILED
+        self.error = error
+        self.emit("state-changed")
@@ -0,0 +1,83 @@
+# This file is part of Hangouts GTK
+# Copyright © 2019-2020 Dominik Schütz <do.sch.dev@gmail.com>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import _thread
+from collections import OrderedDict
+
+
+def pixbuf_size(pixbuf):
+    return pixbuf.props.rowstride * pixbuf.props.height
+
+
+class PixbufCache:
+
+    # least recently used cache of pixbufs limited by their pixel memory
+    def __init__(self, max_size):
+        self.__max_size = max_size
+        self.__lock = _thread.allocate_lock()
+        self.__entries = OrderedDict()
+        self.__size = 0
+
+        self.__hits = 0
+        self.__misses = 0
+        self.__evictions = 0
+
+
+    def get(self, key):
+        with self.__lock:
+            pixbuf = self.__entries.get(key, None)
+            if pixbuf is not None:
+                self.__entries.move_to_end(key)
+                self.__hits += 1
+            else:
+                self.__misses += 1
+            return pixbuf
+
+
+    def put(self, key, pixbuf):
+        size = pixbuf_size(pixbuf)
+        with self.__lock:
+            old = self.__entries.pop(key, None)
+            if old is not None:
+                self.__size -= pixbuf_size(old)
+
+            # do not let one huge image flush the whole cache
+            if size > self.__max_size:
+                return
+
+            self.__entries[key] = pixbuf
+            self.__size += size
+
+            while self.__size > self.__max_size:
+                _, evicted = self.__entries.popitem(last=False)
+                self.__size -= pixbuf_size(evicted)
+                self.__evictions += 1
+
+
+    def get_size(self):
+        return self.__size
+
+
+    def get_stats(self):
+        with self.__lock:
+            return {
+                "hits": self.__hits,
+                "misses": self.__misses,
+                "evictions": self.__evictions,
+                "entries": len(self.__entries),
+                "resident_bytes": self.__size,
+                "max_bytes": self.__max_size
+            }
@@ -0,0 +1,105 @@
+# scheduler.py
+#
+# Copyright 2020 Dominik Schütz <do.sch.dev@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+import asyncio
+import concurrent.futures
+
+
+# Runs coroutines handed over from the main thread on the hangups loop.
+# Coroutines with the same key run one after another in order of scheduling,
+# everything else runs concurrently. Needs to be created inside the loop.
+class Scheduler:
+
+    def __init__(self, dispatcher):
+        self.__loop = asyncio.get_running_loop()
+        self.__dispatcher = dispatcher
+        # key -> last task scheduled with key
+        self.__tails = dict()
+        self.__tasks = set()
+        self.__closed = asyncio.Event()
+        self.__last = None
+
+    def schedule(self, coroutine, key=None, callback=None, error_callback=None):
+        # callback(result) or error_callback(exception) are called in the
+        # main loop, the returned Future can be used from any thread
+        future = concurrent.futures.Future()
+
+        def start():
+            previous = self.__tails.get(key, None) if key is not None else None
+            task = self.__loop.create_task(
+                self.__run(coroutine, previous, future, callback, error_callback)
+            )
+            self.__tasks.add(task)
+            task.add_done_callback(self.__tasks.discard)
+
+            if key is not None:
+                self.__tails[key] = task
+
+                def done(task):
+                    if self.__tails.get(key, None) is task:
+                        del self.__tails[key]
+
+                task.add_done_callback(done)
+
+        self.__loop.call_soon_threadsafe(start)
+        return future
+
+    async def __run(self, coroutine, previous, future, callback, error_callback):
+        if previous:
+            # predecessor may fail, its successors run anyway
+            await asyncio.wait([previous])
+
+        # cancelled by the caller before it started
+        if not future.set_running_or_notify_cancel():
+            coroutine.close()
+            return
+
+        try:
+            result = await coroutine
+        except Exception as e:
+            future.set_exception(e)
+            if error_callback:
+                self.__dispatcher.dispatch(error_callback, e)
+            else:
+                print("Scheduler: ", repr(e))
+            return
+
+        future.set_result(result)
+        if callback:
+            self.__dispatcher.dispatch(callback, result)
+
+    def close(self, last=None):
+        # run returns after everything scheduled until now is done and
+        # after coroutine last, which runs once nothing else is running
+        def closed():
+            self.__last = last
+            self.__closed.set()
+
+        self.__loop.call_soon_threadsafe(closed)
+
+    async def run(self):
+        await self.__closed.wait()
+        while self.__tasks:
+            await asyncio.wait(set(self.__tasks))
+
+        if self.__last is not None:
+            try:
+                await self.__last
+            except Exception as e:
+                print("Scheduler: ", repr(e))
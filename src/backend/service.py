@@ -28,6 +28,10 @@ from hangups import Client as HangupsClient, GoogleAuthError, NetworkError
 from hangups import ChatMessageEvent
 
 from ..backend.token_storage import TokenStorage
+from ..backend.event_store import EventStore
+from ..backend.dispatcher import Dispatcher
+from ..backend.scheduler import Scheduler
+from ..backend.user_directory import UserDirectory, UNKNOWN_NAME
 from ..backend.clientwrapper import Client
 from ..backend.conversationlistwrapper import ConversationList
 from ..backend.conversationwrapper import Conversation
@@ -35,22 +39,26 @@ from ..backend.conversationwrapper import Conversation
 class Service(object):
 
     __token_storage = None
+    __event_store = None
+    __dispatcher = None
     __hangups_running = False
-    __asyncio_queue = None
+    __scheduler = None
     __asyncio_loop = None
 
     __client = None
-    __user_list = None
+    __user_directory = None
     __conversation_list = None
 
     __notification_callbacks = list()
     __get_conversation_callbacks = list()
-    __get_userlist_callbacks = list()
+    __get_user_directory_callbacks = list()
 
     __lists_lock = _thread.allocate_lock()
 
     def __init__(self):
         self.__token_storage = TokenStorage()
+        self.__event_store = EventStore()
+        self.__dispatcher = Dispatcher()
         self.__token_storage.get_refresh_token(self.__obtain_refresh_token)
 
 
@@ -89,10 +97,9 @@ class Service(object):
 
             async def start_hangups_client():
 
-                # cache loop and queue
+                # cache loop and scheduler
                 self.__asyncio_loop = asyncio.get_running_loop()
-                self.__asyncio_queue = asyncio.Queue(loop=self.__asyncio_loop)
-                self.__asyncio_queue.continue_queue = True
+                self.__scheduler = Scheduler(self.__dispatcher)
 
                 # wait for hangouts to connect or raise an exception
                 on_connect = asyncio.Future()
@@ -115,46 +122,76 @@ class Service(object):
                     user_list, conversation_list = ret
 
                     # create wrapper objects
-                    self.__client = Client(hangups_client, self.__asyncio_queue)
+                    self.__client = Client(
+                        hangups_client, self.__scheduler, self.__dispatcher
+                    )
                     with self.__lists_lock:
+                        self.__user_directory = UserDirectory(
+                            user_list,
+                            self.__scheduler,
+                            self.__event_store
+                        )
                         self.__conversation_list = ConversationList(
-                            conversation_list, self.__asyncio_queue
+                            conversation_list,
+                            self.__scheduler,
+                            self.__event_store,
+                            self.__dispatcher,
+                            self.__user_directory
                         )
-                        self.__user_list = user_list
 
                     # give lists to waiting clients
                     for cb in self.__get_conversation_callbacks:
                         idle_add(cb, self.__conversation_list)
-                    for cb in self.__get_userlist_callbacks:
-                        idle_add(cb, self.__user_list)
+                    for cb in self.__get_user_directory_callbacks:
+                        idle_add(cb, self.__user_directory)
 
                     # remove callbacks
                     self.__get_conversation_callbacks.clear()
-                    self.__get_userlist_callbacks.clear()
+                    self.__get_user_directory_callbacks.clear()
 
                     # enable notifications
                     conversation_list.on_event.add_observer(
                         self.__incoming_event
                     )
 
+                    # send what was left in the outbox on last shutdown
+                    self.__dispatcher.dispatch(self.__conversation_list.replay_outbox)
+
+                    # messages that could not be sent while disconnected,
+                    # observers run in order, so hangups' conversation list
+                    # has synced and stored the missed events before
+                    def replay_outbox():
+                        print("reconnect event")
+                        self.__dispatcher.dispatch(self.__conversation_list.replay_outbox)
+
+                    hangups_client.on_reconnect.add_observer(replay_outbox)
+
+                    # remember what has been synced, after the lists are
+                    # shown and without blocking the hangups loop
+                    users = list(user_list.get_all())
+                    events = [
+                        conversation.events
+                        for conversation in conversation_list.get_all(include_archived=True)
+                    ]
+
+                    def store_synced():
+                        self.__event_store.store_users(users)
+                        for conversation_events in events:
+                            self.__event_store.store_events(conversation_events)
+
+                    await asyncio.get_running_loop().run_in_executor(None, store_synced)
 
-                # work through queue
-                async def run_queue():
-                    queue = self.__asyncio_queue
-                    while not queue.empty() or queue.continue_queue:
-                        coro = await queue.get()
-                        await coro
 
                 # create tasks
                 connect_task = asyncio.create_task(hangups_client.connect())
                 build_client_task = asyncio.create_task(build_client())
-                run_queue_task = asyncio.create_task(run_queue())
+                scheduler_task = asyncio.create_task(self.__scheduler.run())
 
                 tasks = (
                     on_connect,
                     connect_task,
                     build_client_task,
-                    run_queue_task
+                    scheduler_task
                 )
 
                 print("pre wait")
@@ -186,13 +223,23 @@ class Service(object):
 
 
     def __incoming_event(self, event):
+        # called in hangups thread
         print("incoming event: ", event)
-        emmiter = self.__user_list.get_user(event.user_id)
+        self.__event_store.store_events([event])
+        self.__dispatcher.dispatch(self.__notify, event)
+
+
+    def __notify(self, event):
+        # senders not known yet are fetched, the message is shown anyway
+        emmiter = self.__user_directory.get_user(event.user_id)
+        self_user = self.__user_directory.get_self_user()
+        is_self = emmiter.is_self if emmiter is not None \
+            else self_user is not None and self_user.id_ == event.user_id
         app = Gio.Application.get_default()
         win = app.props.active_window
         if isinstance(event, ChatMessageEvent):
-            if not emmiter.is_self or win and win.props.is_active:
-                title = emmiter.full_name
+            if not is_self or win and win.props.is_active:
+                title = emmiter.full_name if emmiter is not None else UNKNOWN_NAME
 
                 notification: Gio.Notification = Gio.Notification.new(title)
                 notification.set_body(event.text)
@@ -222,11 +269,12 @@ class Service(object):
                 self.__get_conversation_callbacks.append(callback)
 
 
-    def get_userlist_async(self, callback):
-        if self.__user_list:
-            idle_add(callback, self.__user_list)
-        else:
-            self.__get_userlist_callbacks.append(callback)
+    def get_user_directory_async(self, callback):
+        with self.__lists_lock:
+            if self.__user_directory:
+                idle_add(callback, self.__user_directory)
+            else:
+                self.__get_user_directory_callbacks.append(callback)
 
 
     def quit(self):
@@ -235,4 +283,5 @@ class Service(object):
 
     def logout(self):
         self.__token_storage.reset_refresh_token()
+        self.__event_store.clear()
         self.quit()
@@ -0,0 +1,135 @@
+# user_directory.py
+#
+# Copyright 2020 Dominik Schütz <do.sch.dev@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+from gi.repository import GObject, GLib
+from hangups import hangouts_pb2
+from hangups.user import User, NameType
+
+from ..backend.image_cache import normalize_url
+
+UNKNOWN_NAME = "Unknown"
+
+
+# every known user once for all widgets, users that are missing or only
+# known by a placeholder name are fetched on first lookup
+class UserDirectory(GObject.Object):
+
+    # emitted with the UserID of a user that was fetched or updated
+    __gsignals__ = {
+        "user-changed": (GObject.SignalFlags.RUN_FIRST, None, (object,))
+    }
+
+    def __init__(self, hangups_user_list, scheduler, event_store):
+        super().__init__()
+        self.hangups_user_list = hangups_user_list
+        self.scheduler = scheduler
+        self.event_store = event_store
+
+        # user_id -> User, users of earlier sessions are replaced by the
+        # ones hangups knows now
+        self.__users = {user.id_: user for user in event_store.get_users()}
+        for user in hangups_user_list.get_all():
+            self.__users[user.id_] = user
+        self.__self_user = next(filter(lambda u: u.is_self, hangups_user_list.get_all()), None)
+
+        # user_ids asked for once, failed lookups are not repeated
+        self.__requested = set()
+        # user_ids collected for the next request
+        self.__missing = set()
+        self.__fetch_source = None
+
+    def get_user(self, user_id):
+        # User or None while it is unknown
+        user = self.__users.get(user_id, None)
+        if user is None:
+            # hangups learns about new participants on its own
+            user = self.hangups_user_list._user_dict.get(user_id, None)
+            if user is not None:
+                self.__users[user_id] = user
+
+        if user is None or user.name_type == NameType.DEFAULT:
+            self.__fetch(user_id)
+        return user
+
+    def get_self_user(self):
+        return self.__self_user
+
+    def get_first_name(self, user_id):
+        user = self.get_user(user_id)
+        return user.first_name if user is not None else UNKNOWN_NAME
+
+    def get_photo_url(self, user_id):
+        # https URL of the profile photo or None
+        user = self.get_user(user_id)
+        return normalize_url(user.photo_url) if user is not None else None
+
+    def __fetch(self, user_id):
+        if user_id in self.__requested:
+            return
+        self.__requested.add(user_id)
+        self.__missing.add(user_id)
+
+        # users looked up while building a view share one request
+        if self.__fetch_source is None:
+            self.__fetch_source = GLib.idle_add(self.__fetch_missing)
+
+    def __fetch_missing(self):
+        self.__fetch_source = None
+        user_ids = list(self.__missing)
+        self.__missing.clear()
+
+        client = self.hangups_user_list._client
+        self_id = self.__self_user.id_ if self.__self_user else None
+
+        async def async_fetch():
+            response = await client.get_entity_by_id(
+                hangouts_pb2.GetEntityByIdRequest(
+                    request_header=client.get_request_header(),
+                    batch_lookup_spec=[
+                        hangouts_pb2.EntityLookupSpec(
+                            gaia_id=user_id.gaia_id,
+                            create_offnetwork_gaia=True
+                        )
+                        for user_id in user_ids
+                    ]
+                )
+            )
+            return [
+                User.from_entity(entity, self_id)
+                for entity_result in response.entity_result
+                for entity in entity_result.entity
+            ]
+
+        def failed(error):
+            print("UserDirectory.fetch: ", error)
+
+        self.scheduler.schedule(
+            async_fetch(),
+            callback=self.__fetched,
+            error_callback=failed
+        )
+        return False
+
+    def __fetched(self, users):
+        # placeholders do not replace what is known
+        users = [u for u in users if u.name_type != NameType.DEFAULT or u.id_ not in self.__users]
+        self.event_store.store_users(users)
+        for user in users:
+            self.__users[user.id_] = user
+            self.emit("user-changed", user.id_)
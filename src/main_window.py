@@ -14,17 +14,31 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+from collections import OrderedDict
+
 from gi.repository import Gtk, Handy, Gio, GLib
 
 from hangups.conversation_event import (ChatMessageEvent, HangoutEvent)
 
 from .backend.image_cache import ImageCache
+from .backend.conversation_snapshot import ConversationSnapshot
 from .backend.service import Service
 
-from .widgets.conversation_sidebar_element import ConversationSidebarElement
 from .widgets.conversation_sidebar import ConversationSidebar
 from .widgets.message_box import MessageBox
 from .widgets.conversation_edit_panel import ConversationEditPanel
+from .widgets.search_popover import SearchPopover
+
+# MessageBoxes kept in message_view unless set in GSettings
+MESSAGE_BOX_LIMIT = 5
+
+
+def _get_message_box_limit():
+    # schema is missing when running uninstalled
+    source = Gio.SettingsSchemaSource.get_default()
+    if source and source.lookup("com.dosch.HangoutsGTK", True):
+        return max(1, Gio.Settings.new("com.dosch.HangoutsGTK").get_int("message-box-limit"))
+    return MESSAGE_BOX_LIMIT
 
 
 @Gtk.Template(resource_path="/com/dosch/HangoutsGTK/ui/main_window.ui")
@@ -45,6 +59,7 @@ class MainWindow(Gtk.ApplicationWindow):
     menu_button = Gtk.Template.Child()
     group_button: Gtk.Button = Gtk.Template.Child()
     hangout_button: Gtk.Button = Gtk.Template.Child()
+    search_button1: Gtk.ToggleButton = Gtk.Template.Child()
 
 
     def __init__(self, service, *args, **kwargs):
@@ -53,6 +68,7 @@ class MainWindow(Gtk.ApplicationWindow):
         self.__assemble_login()
         self.__assemble_sidebar()
         self.__assemble_header_bar_elements()
+        self.__assemble_search()
 
         self.__add_actions()
 
@@ -62,6 +78,24 @@ class MainWindow(Gtk.ApplicationWindow):
         # create ImageCache
         self.__image_cache = ImageCache()
 
+        # show conversations of last session until hangups is connected
+        self.__conversation_list = None
+        self.__snapshot = ConversationSnapshot()
+        self.__show_snapshot()
+
+        def destroyed(window):
+            if self.__conversation_list:
+                self.__snapshot.save(self.__conversation_list.get_all())
+            self.__image_cache.close()
+
+        self.connect("destroy", destroyed)
+
+        # conversation_id -> MessageBox, least recently shown first, and
+        # conversation_id -> state of a destroyed MessageBox
+        self.__message_boxes = OrderedDict()
+        self.__message_box_states = dict()
+        self.__message_box_limit = _get_message_box_limit()
+
         # communicate with hangups
         self.__service = service
         self.__service.get_conversation_list_async(self.__get_conversation_list)
@@ -135,8 +169,7 @@ class MainWindow(Gtk.ApplicationWindow):
         # handle click on sidebar element
         def selected(box, row: Gtk.ListBoxRow):
             # show correct chat
-            sidebar_element = row.get_children()[0]
-            conv_id = sidebar_element.get_id()
+            conv_id = row.get_id()
 
             # open correct box
             self.__open_message_box(None, GLib.Variant("s", conv_id))
@@ -158,6 +191,29 @@ class MainWindow(Gtk.ApplicationWindow):
         self.connect("focus-in-event", focused)
 
 
+    def __assemble_search(self):
+        # built once, every conversation list is searched by the same popover
+        search_popover = SearchPopover(relative_to=self.search_button1)
+        self.__search_popover = search_popover
+
+        self.search_button1.connect(
+            "toggled",
+            lambda button: search_popover.popup() if button.get_active() \
+                else search_popover.popdown()
+        )
+        search_popover.connect(
+            "closed",
+            lambda popover: self.search_button1.set_active(False)
+        )
+
+        # open conversation at found message
+        def result_activated(popover, conversation_id, event_id):
+            self.__open_message_box(None, GLib.Variant("s", conversation_id))
+            self.message_view.get_child_by_name(conversation_id).scroll_to_event(event_id)
+
+        search_popover.connect("result-activated", result_activated)
+
+
     def __assemble_login(self):
 
         self.login_window = None
@@ -194,25 +250,34 @@ class MainWindow(Gtk.ApplicationWindow):
         return self.props.has_toplevel_focus
 
 
+    def __show_snapshot(self):
+        entries = self.__snapshot.load()
+        if not entries:
+            return
+
+        self.conversation_sidebar.add_entries(entries, self.__image_cache)
+        self.main_stack.set_visible_child_name("content_box")
+
+
     def __get_conversation_list(self, conversation_list):
         # TODO: self.__service.set_active()
 
         if conversation_list is None:
+            self.__snapshot.clear()
             self.main_stack.set_visible_child_name("login_page")
             print("show login_page")
             return
 
         self.__conversation_list = conversation_list
-        for conversation in conversation_list.get_all():
-            self.conversation_sidebar.prepend(
-                ConversationSidebarElement(
-                    self, conversation, self.__image_cache
-                )
-            )
 
-        self.conversation_sidebar.show_all()
+        self.conversation_sidebar.set_conversation_list(
+            conversation_list, self.__image_cache
+        )
         self.main_stack.set_visible_child_name("content_box")
 
+        self.__search_popover.set_conversation_list(conversation_list)
+        self.search_button1.set_visible(True)
+
         if self.__active_id:
             self.__open_message_box(
                 None,
@@ -227,7 +292,13 @@ class MainWindow(Gtk.ApplicationWindow):
         self.message_view.foreach(
             lambda child, x: self.message_view.remove(child), None
         )
+        self.__message_boxes.clear()
+        self.__message_box_states.clear()
         self.conversation_list_viewport.remove(self.conversation_sidebar)
+        self.__snapshot.clear()
+        self.__conversation_list = None
+        self.__search_popover.set_conversation_list(None)
+        self.search_button1.set_visible(False)
         self.__conversations = {}
         self.__client = None
         self.__active_id = None
@@ -248,13 +319,24 @@ class MainWindow(Gtk.ApplicationWindow):
         # current conversation
         conversation = self.__conversation_list.get(conversation_id)
 
-        if not self.message_view.get_child_by_name(conversation_id):
-            # create message_box
-            msg_box = MessageBox(conversation, self.__image_cache)
+        msg_box = self.__message_boxes.get(conversation_id, None)
+        if msg_box is None:
+            # create message_box, as it was when it got evicted
+            msg_box = MessageBox(
+                conversation,
+                self.__image_cache,
+                self.__conversation_list.get_user_directory()
+            )
             self.message_view.add_named(msg_box, conversation_id)
+            state = self.__message_box_states.pop(conversation_id, None)
+            if state:
+                msg_box.restore_state(state)
+            self.__message_boxes[conversation_id] = msg_box
+        self.__message_boxes.move_to_end(conversation_id)
 
         self.message_view.set_visible_child_name(conversation_id)
         self.__active_id = conversation_id
+        self.__evict_message_boxes()
 
         # show chat side of leaflets
         self.leaflet.set_visible_child(self.panel_headerbar)
@@ -270,6 +352,15 @@ class MainWindow(Gtk.ApplicationWindow):
             )))
 
 
+    def __evict_message_boxes(self):
+        # destroys least recently shown boxes, their observers and widgets
+        # go with them
+        while len(self.__message_boxes) > self.__message_box_limit:
+            conversation_id, msg_box = self.__message_boxes.popitem(last=False)
+            self.__message_box_states[conversation_id] = msg_box.get_state()
+            msg_box.destroy()
+
+
     def __add_actions(self):
         show_conversation = Gio.SimpleAction.new(
             "show-conversation",
@@ -0,0 +1,149 @@
+# This file is part of Hangouts GTK
+# Copyright © 2019-2020 Dominik Schütz <do.sch.dev@gmail.com>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from gi.repository import Gtk, GLib
+
+from ..backend.image_cache import PRIORITY_LOW
+
+MIN_FRAME_DELAY = 20
+
+
+# image that shows a static preview and plays the animation behind url only
+# while it is visible inside its scrolled window
+class AnimatedImage(Gtk.Image):
+
+    def __init__(self, image_cache, url, size, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+
+        self.__image_cache = image_cache
+        self.__url = url
+        self.__size = size
+
+        self.__preview = None
+        # None as long as it is unknown if url is animated
+        self.__is_animated = None
+        self.__request = None
+        self.__animation_iter = None
+        self.__timeout = None
+
+        self.__adjustment = None
+        self.__adjustment_handler = None
+
+        self.connect("map", self.__on_map)
+        self.connect("unmap", self.__on_unmap)
+        self.connect("destroy", self.__on_unmap)
+
+
+    def set_preview(self, pixbuf):
+        self.__preview = pixbuf
+        if self.__animation_iter is None:
+            self.set_from_pixbuf(pixbuf)
+
+
+    def __on_map(self, widget):
+        scrolled_window = self.get_ancestor(Gtk.ScrolledWindow)
+        if scrolled_window:
+            self.__adjustment = scrolled_window.get_vadjustment()
+            self.__adjustment_handler = self.__adjustment.connect(
+                "value-changed",
+                lambda adjustment: self.__update()
+            )
+        self.__update()
+
+
+    def __on_unmap(self, widget):
+        if self.__adjustment_handler:
+            self.__adjustment.disconnect(self.__adjustment_handler)
+            self.__adjustment = self.__adjustment_handler = None
+        self.__stop()
+
+
+    def __is_on_screen(self):
+        if not self.get_mapped():
+            return False
+
+        scrolled_window = self.get_ancestor(Gtk.ScrolledWindow)
+        if not scrolled_window:
+            return True
+
+        coordinates = self.translate_coordinates(scrolled_window, 0, 0)
+        if coordinates is None:
+            return False
+        _, y = coordinates
+        return y + self.get_allocated_height() > 0 and y < scrolled_window.get_allocated_height()
+
+
+    def __update(self):
+        if self.__is_animated is False:
+            return
+
+        if self.__is_on_screen():
+            self.__play()
+        else:
+            self.__stop()
+
+
+    def __play(self):
+        if self.__animation_iter or self.__request:
+            return
+
+        def got_animation(animation):
+            self.__request = None
+            if animation is None:
+                self.__is_animated = False
+                return
+            self.__is_animated = True
+
+            # user might have scrolled away while decoding
+            if not self.__is_on_screen():
+                return
+
+            self.__animation_iter = animation.get_iter(None)
+            self.__next_frame()
+
+        self.__request = self.__image_cache.get_animation(
+            self.__url,
+            got_animation,
+            self.__size,
+            priority=PRIORITY_LOW
+        )
+
+
+    def __stop(self):
+        if self.__request:
+            self.__request.cancel()
+            self.__request = None
+
+        if self.__timeout:
+            GLib.source_remove(self.__timeout)
+            self.__timeout = None
+
+        # drops the decoded frames
+        if self.__animation_iter:
+            self.__animation_iter = None
+            if self.__preview:
+                self.set_from_pixbuf(self.__preview)
+
+
+    def __next_frame(self):
+        self.__timeout = None
+        self.__animation_iter.advance(None)
+        self.set_from_pixbuf(self.__animation_iter.get_pixbuf())
+
+        delay = self.__animation_iter.get_delay_time()
+        if delay >= 0:
+            self.__timeout = GLib.timeout_add(max(delay, MIN_FRAME_DELAY), self.__next_frame)
+        return False
@@ -14,9 +14,7 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-from gi.repository import Gtk, Gdk
-import cairo
-import math
+from gi.repository import Gtk
 
 
 @Gtk.Template(resource_path="/com/dosch/HangoutsGTK/ui/conversation_edit_user_element.ui")
@@ -35,33 +33,11 @@ class ConversationEditUserElement(Gtk.Box):
         # set text
         self.user_name.set_text(user.full_name)
 
-        # set icon
-        def got_item(image):
-            width, height = image.get_width(), image.get_height()
-            scale = width / height if width > height else height / width
-            radius_2 = height if width > height else width
-            radius = radius_2 / 2
-
-            icon_width = Gtk.IconSize.lookup(Gtk.IconSize.DND)[1]
-            scale *= radius_2 / icon_width
-
-            offset = (radius_2 - icon_width) / 2
-
-            def paint(wid, cr):
-                surface = Gdk.cairo_surface_create_from_pixbuf(image, 0, None)
-                surface.set_device_scale(scale, scale)
-
-                cr.set_source_surface(surface, offset, offset)
-                cr.arc(radius, radius, icon_width / 2, 0, 2 * math.pi)
-                cr.clip()
-                cr.paint()
-
-                return False
-
-            self.preview_image.set_from_surface(cairo.ImageSurface(cairo.FORMAT_ARGB32, int(radius_2), int(radius_2)))
-            self.preview_image.connect("draw", paint)
-
-        image_cache.get_image(
-            user.photo_url,
-            got_item
-        )
+        # set icon, users of conversation participant data have no photo
+        if user.photo_url:
+            avatar_request = image_cache.get_avatar(
+                [user.photo_url],
+                self.preview_image.set_from_surface,
+                Gtk.IconSize.lookup(Gtk.IconSize.DND)[1]
+            )
+            self.connect("destroy", lambda widget: avatar_request.cancel())
@@ -14,7 +14,82 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-from gi.repository import Gtk
+import datetime
+
+from gi.repository import Gtk, GLib
+
+from ..backend.conversation_snapshot import snapshot_entry
+from ..widgets.conversation_sidebar_element import ConversationSidebarElement
+
+# rows this far outside of the visible area count as on screen
+VISIBLE_MARGIN = 200
+# height of a row before its element is built
+ROW_HEIGHT = 60
+
+
+# placeholder of fixed height for a conversation, the element showing it
+# is only built when the row comes on screen for the first time
+class ConversationSidebarRow(Gtk.ListBoxRow):
+
+    def __init__(self, conversation_id, image_cache, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.set_size_request(-1, ROW_HEIGHT)
+
+        self.__id = conversation_id
+        self.__image_cache = image_cache
+        self.__entry = None
+        self.__conversation = None
+        self.__last_modified = None
+        self.__element = None
+
+    def set_entry(self, entry):
+        # snapshot entry, shown until there is a conversation
+        self.__entry = entry
+        self.__last_modified = datetime.datetime.fromtimestamp(
+            entry["last_modified"], datetime.timezone.utc
+        )
+
+    def set_conversation(self, conversation):
+        self.__conversation = conversation
+        self.__last_modified = conversation.get_last_modified()
+        if self.__element:
+            self.__element.set_conversation(conversation)
+
+    def set_on_screen(self, on_screen):
+        if on_screen and self.__element is None:
+            if self.__conversation:
+                entry = snapshot_entry(self.__conversation)
+            else:
+                entry = self.__entry
+            self.__element = ConversationSidebarElement(entry, self.__image_cache)
+            if self.__conversation:
+                self.__element.set_conversation(self.__conversation, entry)
+            self.__element.show_all()
+            self.add(self.__element)
+            self.__entry = None
+
+        if self.__element:
+            self.__element.set_on_screen(on_screen)
+
+    def add_event(self, event):
+        if self.__element:
+            self.__element.add_event(event)
+            return
+        # everything else is read from the conversation once built
+        self.__last_modified = max(self.__last_modified, event.timestamp)
+        self.changed()
+
+    def read_status_changed(self, watermark_event):
+        if self.__element:
+            self.__element.read_status_changed(watermark_event)
+
+    def get_id(self):
+        return str(self.__id)
+
+    def get_last_modified(self):
+        if self.__element:
+            return self.__element.get_last_modified()
+        return self.__last_modified
 
 
 @Gtk.Template(resource_path="/com/dosch/HangoutsGTK/ui/conversation_sidebar.ui")
@@ -23,3 +98,141 @@ class ConversationSidebar(Gtk.ListBox):
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
+
+        # conversation_id -> ConversationSidebarRow
+        self.__rows = dict()
+        self.__on_screen = set()
+        self.__update_source = None
+
+        self.__conversation_list = None
+        self.__on_event_callback = None
+        self.__on_watermark_callback = None
+
+        self.__adjustment = None
+        self.__adjustment_handler = None
+
+        # most recently modified conversation first
+        def sort(row1, row2):
+            modified1 = row1.get_last_modified()
+            modified2 = row2.get_last_modified()
+            return (modified1 < modified2) - (modified1 > modified2)
+
+        self.set_sort_func(sort)
+
+        self.connect("map", self.__on_map)
+        self.connect("unmap", self.__on_unmap)
+        self.connect("destroy", self.__on_destroy)
+        self.connect("size-allocate", lambda sidebar, allocation: self.__schedule_update())
+
+
+    def add_entries(self, entries, image_cache):
+        # rows for snapshot entries, shown until set_conversation_list
+        for entry in entries:
+            row = ConversationSidebarRow(entry["id"], image_cache)
+            row.set_entry(entry)
+            self.__add_row(row)
+
+
+    def set_conversation_list(self, conversation_list, image_cache):
+        # update rows shown from snapshot, add new and drop gone conversations
+        gone = dict(self.__rows)
+        for conversation in conversation_list.get_all():
+            row = gone.pop(conversation.id_, None)
+            if row is None:
+                row = ConversationSidebarRow(conversation.id_, image_cache)
+                row.set_conversation(conversation)
+                self.__add_row(row)
+            else:
+                row.set_conversation(conversation)
+
+        for conversation_id, row in gone.items():
+            del self.__rows[conversation_id]
+            self.__on_screen.discard(row)
+            row.destroy()
+
+        self.invalidate_sort()
+        self.__schedule_update()
+
+        # one observer for all rows, visible or not
+        self.__conversation_list = conversation_list
+        self.__on_event_callback = conversation_list.connect_on_event(
+            lambda event: self.__dispatch(event.conversation_id, "add_event", event)
+        )
+        self.__on_watermark_callback = conversation_list.connect_on_watermark_notification(
+            lambda watermark: self.__dispatch(watermark.conv_id, "read_status_changed", watermark)
+        )
+
+
+    def __add_row(self, row):
+        self.__rows[row.get_id()] = row
+        row.show()
+        self.add(row)
+
+
+    def __dispatch(self, conversation_id, method, argument):
+        row = self.__rows.get(conversation_id, None)
+        if row:
+            getattr(row, method)(argument)
+
+
+    def __on_map(self, widget):
+        scrolled_window = self.get_ancestor(Gtk.ScrolledWindow)
+        if scrolled_window:
+            self.__adjustment = scrolled_window.get_vadjustment()
+            self.__adjustment_handler = self.__adjustment.connect(
+                "value-changed",
+                lambda adjustment: self.__schedule_update()
+            )
+        self.__schedule_update()
+
+
+    def __on_unmap(self, widget):
+        if self.__adjustment_handler:
+            self.__adjustment.disconnect(self.__adjustment_handler)
+            self.__adjustment = self.__adjustment_handler = None
+
+
+    def __on_destroy(self, widget):
+        self.__on_unmap(widget)
+        if self.__update_source:
+            GLib.source_remove(self.__update_source)
+            self.__update_source = None
+        if self.__conversation_list:
+            self.__conversation_list.disconnect_on_event(self.__on_event_callback)
+            self.__conversation_list.disconnect_on_watermark_notification(self.__on_watermark_callback)
+            self.__conversation_list = None
+
+
+    def __schedule_update(self):
+        if self.__update_source is None:
+            self.__update_source = GLib.idle_add(self.__update_on_screen)
+
+
+    def __update_on_screen(self):
+        self.__update_source = None
+
+        # rows are not allocated yet, size-allocate comes back here
+        if not self.__adjustment or not self.get_mapped() or self.get_allocated_height() <= 1:
+            return False
+
+        value = self.__adjustment.get_value()
+        top = self.get_row_at_y(int(max(0, value - VISIBLE_MARGIN)))
+        bottom = self.get_row_at_y(int(value + self.__adjustment.get_page_size() + VISIBLE_MARGIN))
+
+        n_rows = len(self.__rows)
+        first = top.get_index() if top else 0
+        last = bottom.get_index() if bottom else n_rows - 1
+
+        on_screen = set()
+        for index in range(first, last + 1):
+            row = self.get_row_at_index(index)
+            if row:
+                on_screen.add(row)
+
+        for row in self.__on_screen - on_screen:
+            row.set_on_screen(False)
+        for row in on_screen - self.__on_screen:
+            row.set_on_screen(True)
+        self.__on_screen = on_screen
+
+        return False
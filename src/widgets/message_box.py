@@ -21,6 +21,8 @@ import giofile
 from gi.repository import Gtk, Gdk, Pango, Gio, GLib
 
 from ..widgets.message_views import ChatMessageOwn, ChatMessageForeign, ChatInfo, ChatInfoTimeless
+from ..widgets.message_list_model import MessageListModel
+from ..backend.outgoing_message import PENDING, SENT, FAILED
 
 from hangups.conversation_event import (ChatMessageEvent, OTREvent, RenameEvent, MembershipChangeEvent, HangoutEvent, GroupLinkSharingModificationEvent)
 from hangups import ChatMessageSegment
@@ -28,6 +30,15 @@ from hangups import hangouts_pb2
 
 url_regex = re.compile(r"(?:http(s)?:\/\/)?[\w.-]+(?:\.[\w\.-]+)+[\w\-\._~:/?#[\]@!\$&'\(\)\*\+,;=.]+")
 
+# only a window of the timeline is realized as widgets
+WINDOW_SIZE = 60
+WINDOW_STEP = 20
+# distance to the ends of the window in pixels that moves the window
+WINDOW_MARGIN = 400
+# older events are requested after staying near the top for a moment
+HISTORY_DELAY = 150
+HISTORY_PAGE_SIZE = 50
+
 
 @Gtk.Template(resource_path="/com/dosch/HangoutsGTK/ui/message_box.ui")
 class MessageBox(Gtk.Box):
@@ -43,25 +54,22 @@ class MessageBox(Gtk.Box):
     text_input: Gtk.TextView = Gtk.Template.Child()
     message_sending_spinner: Gtk.Spinner = Gtk.Template.Child()
     to_bottom_button: Gtk.Button = Gtk.Template.Child()
+    pending_messages: Gtk.ListBox = Gtk.Template.Child()
 
 
-    def __init__(self, conversation, image_cache, *args, **kwargs):
+    def __init__(self, conversation, image_cache, user_directory, *args, **kwargs):
         super().__init__(*args, **kwargs)
 
         self.__conversation = conversation
-        self.__own_id = next(filter(lambda u: u.is_self, conversation.users), None).id_
+        self.__user_directory = user_directory
+        self.__own_id = conversation.get_self_user().id_
         self.__image_cache = image_cache
-        self.__last_event = self.__first_event = None
-        self.__pending_messages = 0
+        # OutgoingMessage -> (row in pending_messages, handler id)
+        self.__pending = dict()
         self.__scroll_down = True
         self.__send_file = None
 
-        self.connect("destroy", self.destroy)
-
-        # cache all users of conversation
-        self.__user_dict = {}
-        for user in conversation.users:
-            self.__user_dict[user.id_] = user
+        self.connect("destroy", self.__destroyed)
 
         # insert text listener
         buffer: Gtk.TextTag = self.text_input.props.buffer
@@ -156,15 +164,17 @@ class MessageBox(Gtk.Box):
                     buffer.props.text = ""
 
                     file = None
+                    path = None
                     if self.__send_file:
-                        # TODO: close file when upload is finished. As for now file should be closed, when it is deallocated
-                        file = giofile.open(self.__send_file, 'rb')
+                        # local files are kept in the outbox by path
+                        path = self.__send_file.get_path()
+                        if path is None:
+                            # TODO: close file when upload is finished. As for now file should be closed, when it is deallocated
+                            file = giofile.open(self.__send_file, 'rb')
                         # change view
                         self.photo_button.set_visible(True)
                         self.delete_attachment.set_visible(False)
-                    self.__conversation.send_message(segments, image_file=file)
-                    self.message_sending_spinner.set_visible(True)
-                    self.__pending_messages += 1
+                    self.__add_pending(self.__conversation.send_message(segments, image_file=file, image_path=path))
 
                     del file
                     self.__send_file = None
@@ -205,31 +215,67 @@ class MessageBox(Gtk.Box):
 
         self.text_input.connect("key-press-event", key_press_event)
 
-        # add conversation events now
-        self.__add_events(self.__conversation.events, append_bottom=True)
+        # timeline model, rows [window_start, window_end) are realized
+        self.__window_start = self.__window_end = 0
+        self.__window_check = None
+        self.__anchor = None
+        self.__model = MessageListModel()
+        self.__model.get_store().connect("items-changed", self.__items_changed)
+        self.__model.connect("group-extended", self.__group_extended)
+
+        # requests still running when the box is destroyed find it out here
+        self.__is_destroyed = False
+
+        # scroll back state
+        self.__history_timeout = None
+        self.__history_loading = False
+        self.__history_complete = False
+
+        # add conversation events now, from hangups and from local history
+        # once server history reached it, before that stored events may
+        # miss what happened while the app was closed
+        self.__model.add_events(self.__conversation.get_events_between())
+        if self.__conversation.is_history_reconciled():
+            self.__model.add_events(self.__conversation.get_cached_events(max_events=HISTORY_PAGE_SIZE))
+        else:
+            self.__load_history()
+
+        # messages sent before this box existed
+        for message in self.__conversation.get_outgoing_messages():
+            self.__add_pending(message)
+
+        # failed messages are sent again on click
+        def pending_activated(listbox, row):
+            self.__conversation.retry_message(row.message)
 
-        # add conversation events later
-        self.__conversation.get_events(self.__add_events, conversation.events[0].id_)
+        self.pending_messages.connect("row-activated", pending_activated)
 
         # add listeners for incoming messages
         def incoming_message(event):
-            self.__add_events([event], True)
-            self.__pending_messages -= 1
-            if self.__pending_messages <= 0:
-                self.__pending_messages = 0
-                self.message_sending_spinner.set_visible(False)
+            self.__model.add_events([event])
         self.__add_event_callback = self.__conversation.connect_on_event(incoming_message)
 
-        # handle scroll down
+        # handle scroll down, otherwise keep top row in place
         def size_changed(messages, allocation):
+            adj: Gtk.Adjustment = self.scrolled_window.get_vadjustment()
             if self.__scroll_down:
-                adj: Gtk.Adjustment = self.scrolled_window.get_vadjustment()
                 adj.set_value(adj.get_upper() - adj.get_page_size())
+            elif self.__anchor:
+                row, offset = self.__anchor
+                if row.get_parent() is self.messages:
+                    adj.set_value(row.get_allocation().y - offset)
+            self.__schedule_window_check()
 
         self.messages.connect("size-allocate", size_changed)
+        self.pending_messages.connect("size-allocate", size_changed)
 
         # handle animated scroll down
         def animated_scroll_down(button):
+            # window does not reach the bottom, jump there
+            if self.__window_end < self.__model.get_n_items():
+                self.__reset_window()
+                return
+
             # inspired by Julian Sparbers animated scroll in fractal
             # GTK3 license
             adj: Gtk.Adjustment = self.scrolled_window.get_vadjustment()
@@ -284,6 +330,7 @@ class MessageBox(Gtk.Box):
 
         # add listener to remove attachment
         def on_delete_button_clicked(button):
+            self.__send_file = None
             self.delete_attachment.set_visible(False)
             self.photo_button.set_visible(True)
 
@@ -292,77 +339,371 @@ class MessageBox(Gtk.Box):
         # add listener to scrollbar change
         def on_scrollbar_value_changed(adjustment: Gtk.Adjustment):
             # when scrolled to bottom
-            if adjustment.get_value() == adjustment.get_upper() - adjustment.get_page_size():
+            if adjustment.get_value() == adjustment.get_upper() - adjustment.get_page_size() and \
+                    self.__window_end == self.__model.get_n_items():
                 self.to_bottom_button.set_state_flags(Gtk.StateFlags.INSENSITIVE, False)
                 self.__scroll_down = True
             else:
                 self.to_bottom_button.unset_state_flags(Gtk.StateFlags.INSENSITIVE)
                 self.__scroll_down = False
+                self.__save_anchor()
+            self.__schedule_window_check()
 
         self.scrolled_window.get_vadjustment().connect("value-changed", on_scrollbar_value_changed)
 
 
-    def __add_events(self, event_list, append_bottom=False):
+    def __create_widget(self, group):
+        event = group.events[0]
 
-        if append_bottom:
-            it = event_list
-            recentevent = self.__last_event
-            add_func = self.messages.add
+        if isinstance(event, ChatMessageEvent):
+            if event.user_id == self.__own_id:
+                widget = ChatMessageOwn(event, self.__image_cache)
+            else:
+                widget = ChatMessageForeign(event, self.__image_cache, self.__user_directory)
+            for chat_message in group.events[1:]:
+                widget.append(chat_message, self.__image_cache)
+
+        elif isinstance(event, HangoutEvent):
+            widget = ChatInfo()
+            widget.set_hangout_event(event, self.__user_directory)
+        elif isinstance(event, MembershipChangeEvent):
+            widget = ChatInfo()
+            widget.set_membership_change_event(event, self.__user_directory)
+        elif isinstance(event, RenameEvent):
+            widget = ChatInfoTimeless()
+            widget.set_rename_event(event, self.__user_directory)
+        elif isinstance(event, GroupLinkSharingModificationEvent):
+            widget = ChatInfoTimeless()
+            widget.set_group_sharing_event(event, self.__user_directory)
+        elif isinstance(event, OTREvent):
+            widget = ChatInfoTimeless()
+            widget.set_group_sharing_eventChatOtrInfo(event)
         else:
-            it = reversed(event_list)
-            recentevent = self.__first_event
-            add_func = self.messages.prepend
+            widget = Gtk.Label("?")
 
-        for event in it:
+        return widget
 
-            widget = None
 
-            if isinstance(event, ChatMessageEvent):
-                if isinstance(recentevent, (ChatMessageOwn, ChatMessageForeign)) and event.user_id == recentevent.user_id and abs(event.timestamp - recentevent.timestamp).total_seconds() < 20 * 60:  # create new bubble after 20 minutes
-                    if append_bottom:
-                        recentevent.append(event, self.__image_cache)
-                    else:
-                        recentevent.prepend(event, self.__image_cache)
-                    continue
-                elif event.user_id == self.__own_id:
-                    widget = ChatMessageOwn(event, self.__image_cache)
-                else:
-                    widget = ChatMessageForeign(event, self.__image_cache, self.__user_dict)
-
-            elif isinstance(event, HangoutEvent):
-                widget = ChatInfo()
-                widget.set_hangout_event(event, self.__user_dict)
-            elif isinstance(event, MembershipChangeEvent):
-                widget = ChatInfo()
-                widget.set_membership_change_event(event, self.__user_dict)
-            elif isinstance(event, RenameEvent):
-                widget = ChatInfoTimeless()
-                widget.set_rename_event(event, self.__user_dict)
-            elif isinstance(event, GroupLinkSharingModificationEvent):
-                widget = ChatInfoTimeless()
-                widget.set_group_sharing_event(event, self.__user_dict)
-            elif isinstance(event, OTREvent):
-                widget = ChatInfoTimeless()
-                widget.set_group_sharing_eventChatOtrInfo(event)
-            else:
-                widget = Gtk.Label("?")
+    def __insert_row(self, position):
+        # realizes group at model position, window needs to contain position
+        widget = self.__create_widget(self.__model.get_item(position))
+        self.messages.insert(widget, position - self.__window_start)
 
-            if append_bottom:
-                self.__last_event = widget
-            else:
-                self.__first_event = widget
 
-            if not (self.__last_event and self.__first_event):
-                self.__last_event = self.__first_event = widget
+    def __remove_row(self, position):
+        self.messages.get_row_at_index(position - self.__window_start).destroy()
+
+
+    def __items_changed(self, store, position, removed, added):
+        start, end = self.__window_start, self.__window_end
+        delta = added - removed
+
+        # change behind window, follow it if window shows the bottom
+        if position >= end:
+            if end == store.get_n_items() - delta and self.__scroll_down:
+                self.__fill_bottom()
+            return
+
+        # change in front of window
+        if position + removed <= start:
+            self.__window_start += delta
+            self.__window_end += delta
+            return
+
+        # change overlaps window
+        for _ in range(max(position, start), min(position + removed, end)):
+            self.__remove_row(max(position, start))
+        self.__window_start = min(start, position)
+        self.__window_end = max(end, position + removed) + delta
+        for new_position in range(position, position + added):
+            self.__insert_row(new_position)
+
+
+    def __group_extended(self, model, position, event, index):
+        if not self.__window_start <= position < self.__window_end:
+            return
+
+        widget = self.messages.get_row_at_index(position - self.__window_start).get_child()
+        if index == 0:
+            widget.prepend(event, self.__image_cache)
+        else:
+            widget.append(event, self.__image_cache)
+
+
+    def __fill_bottom(self):
+        # realize everything up to the bottom and release rows at the top
+        while self.__window_end < self.__model.get_n_items():
+            self.__window_end += 1
+            self.__insert_row(self.__window_end - 1)
+        while self.__window_end - self.__window_start > WINDOW_SIZE:
+            self.__remove_row(self.__window_start)
+            self.__window_start += 1
+
+
+    def __grow_top(self):
+        for _ in range(min(WINDOW_STEP, self.__window_start)):
+            self.__window_start -= 1
+            self.__insert_row(self.__window_start)
+        while self.__window_end - self.__window_start > WINDOW_SIZE:
+            self.__window_end -= 1
+            self.__remove_row(self.__window_end)
+
+
+    def __grow_bottom(self):
+        for _ in range(min(WINDOW_STEP, self.__model.get_n_items() - self.__window_end)):
+            self.__window_end += 1
+            self.__insert_row(self.__window_end - 1)
+        while self.__window_end - self.__window_start > WINDOW_SIZE:
+            self.__remove_row(self.__window_start)
+            self.__window_start += 1
+
+
+    def __reset_window(self, position=None):
+        # show the bottom of the timeline again or the rows around position
+        # with position at the top
+        for _ in range(self.__window_start, self.__window_end):
+            self.__remove_row(self.__window_start)
+
+        if position is None:
+            self.__window_start = self.__window_end = max(0, self.__model.get_n_items() - 2 * WINDOW_STEP)
+            self.__scroll_down = True
+            self.__anchor = None
+            self.__fill_bottom()
+            return
+
+        self.__window_start = self.__window_end = max(0, position - WINDOW_STEP)
+        while self.__window_end < min(self.__model.get_n_items(), position + WINDOW_STEP):
+            self.__window_end += 1
+            self.__insert_row(self.__window_end - 1)
+        self.__scroll_down = False
+        self.__anchor = (self.messages.get_row_at_index(position - self.__window_start), 0)
+
+
+    def __add_pending(self, message):
+        # bubble of a message the server has not confirmed yet
+        if self.__window_end < self.__model.get_n_items():
+            self.__reset_window()
+
+        widget = ChatMessageOwn(message, self.__image_cache)
+        row = Gtk.ListBoxRow()
+        row.message = message
+        row.add(widget)
+        row.show()
+        self.pending_messages.add(row)
+
+        handler = message.connect("state-changed", self.__pending_changed)
+        self.__pending[message] = (row, handler)
+        self.__pending_changed(message)
+
+
+    def __pending_changed(self, message):
+        row, handler = self.__pending[message]
+
+        if message.state == SENT and message.event:
+            # server's event replaces the bubble
+            message.disconnect(handler)
+            del self.__pending[message]
+            row.destroy()
+            self.__model.add_events([message.event])
+        elif message.state == SENT:
+            row.get_child().set_status("Sent")
+        elif message.state == FAILED:
+            row.get_child().set_status("Not sent, click to retry")
+        else:
+            row.get_child().set_status("Sending…")
+
+        row.set_activatable(message.state == FAILED)
+        self.message_sending_spinner.set_visible(
+            any(m.state == PENDING for m in self.__pending)
+        )
+
 
-            add_func(widget)
+    def __save_anchor(self):
+        # remember row at the top of the visible area and its offset
+        value = self.scrolled_window.get_vadjustment().get_value()
+        row = self.messages.get_row_at_y(int(value))
+        if row:
+            self.__anchor = (row, row.get_allocation().y - value)
+
+
+    def __schedule_window_check(self):
+        if self.__window_check is None:
+            self.__window_check = GLib.idle_add(self.__check_window)
+
+
+    def __check_window(self):
+        self.__window_check = None
+        if self.__is_destroyed:
+            return False
+
+        # unsent messages follow the newest message
+        self.pending_messages.set_visible(self.__window_end == self.__model.get_n_items())
+
+        adj: Gtk.Adjustment = self.scrolled_window.get_vadjustment()
+        value, upper, page_size = adj.get_value(), adj.get_upper(), adj.get_page_size()
+
+        if value < WINDOW_MARGIN and self.__window_start > 0:
+            self.__save_anchor()
+            self.__grow_top()
+        elif value < WINDOW_MARGIN:
+            self.__schedule_history()
+        elif value + page_size > upper - WINDOW_MARGIN and \
+                self.__window_end < self.__model.get_n_items():
+            self.__save_anchor()
+            self.__grow_bottom()
+
+        return False
+
+
+    def __schedule_history(self):
+        if self.__history_timeout is None and not self.__history_loading \
+                and not self.__history_complete:
+            self.__history_timeout = GLib.timeout_add(HISTORY_DELAY, self.__load_older)
+
+
+    def __load_older(self):
+        self.__history_timeout = None
+        if self.__is_destroyed:
+            return False
+
+        # local history first, if there is no gap to the loaded events
+        if self.__conversation.is_history_reconciled():
+            events = self.__conversation.get_cached_events(
+                self.__model.get_first_event(),
+                HISTORY_PAGE_SIZE
+            )
+            if events:
+                self.__model.add_events(events)
+                self.__schedule_window_check()
+                return False
+
+        return self.__load_history()
+
+
+    def __load_history(self):
+        if self.__history_loading or self.__history_complete:
+            return False
+
+        # hangups only pages backwards from events it knows
+        first_event = self.__conversation.get_first_event()
+        if first_event is None:
+            return False
+
+        def got_events(events):
+            self.__history_loading = False
+            if self.__is_destroyed:
+                return
+            if events is None:
+                # request failed, try again when scrolled to the top
+                return
+            if not events:
+                # reached the beginning of the conversation
+                self.__history_complete = True
+                return
+            # known events continue paging only if user waits at the top
+            self.__model.add_events(events)
+            self.__schedule_window_check()
+
+        self.__history_loading = True
+        self.__conversation.get_events(got_events, first_event.id_, HISTORY_PAGE_SIZE)
+        return False
+
+
+    def scroll_to_event(self, event_id):
+        if not self.__model.has_event(event_id):
+            event = self.__conversation.get_cached_event(event_id)
+            if event is None:
+                return
+            # everything between event and the timeline, scrolling back
+            # from the timeline's first event must not skip a gap
+            self.__model.add_events([event])
+            self.__model.add_events(self.__conversation.get_cached_events(
+                self.__model.get_first_event(), None, event
+            ))
+
+        self.__reset_window(self.__model.find_event(event_id))
+
+
+    def get_state(self):
+        # what is needed to show this box again as it is after it was
+        # destroyed, as plain data
+        state = {
+            "anchor_event_id": None,
+            "anchor_offset": 0,
+            "draft": self.__get_draft(),
+            "attachment": self.__send_file
+        }
+        if not self.__scroll_down:
+            self.__save_anchor()
+        if not self.__scroll_down and self.__anchor:
+            row, offset = self.__anchor
+            if row.get_parent() is self.messages:
+                group = self.__model.get_item(self.__window_start + row.get_index())
+                state["anchor_event_id"] = group.events[0].id_
+                state["anchor_offset"] = offset
+        return state
+
+
+    def restore_state(self, state):
+        self.__set_draft(state["draft"])
+
+        if state["attachment"]:
+            self.__send_file = state["attachment"]
+            self.image_name.set_text(self.__send_file.get_basename())
+            self.photo_button.set_visible(False)
+            self.delete_attachment.set_visible(True)
+
+        if state["anchor_event_id"]:
+            self.scroll_to_event(state["anchor_event_id"])
+            if self.__anchor:
+                self.__anchor = (self.__anchor[0], state["anchor_offset"])
+
+
+    def __get_draft(self):
+        # text of text_input and (tag name, start offset, end offset) of
+        # its formatting
+        buffer: Gtk.TextBuffer = self.text_input.props.buffer
+        tag_table = buffer.get_tag_table()
+        ranges = list()
+        for name in ("b", "i", "u", "s"):
+            tag = tag_table.lookup(name)
+            iter = buffer.get_start_iter()
+            while True:
+                if iter.has_tag(tag):
+                    start = iter.get_offset()
+                    iter.forward_to_tag_toggle(tag)
+                    ranges.append((name, start, iter.get_offset()))
+                if not iter.forward_to_tag_toggle(tag):
+                    break
+        return (buffer.props.text, ranges)
+
+
+    def __set_draft(self, draft):
+        text, ranges = draft
+        buffer: Gtk.TextBuffer = self.text_input.props.buffer
+        buffer.props.text = text
+        for name, start, end in ranges:
+            buffer.apply_tag_by_name(
+                name,
+                buffer.get_iter_at_offset(start),
+                buffer.get_iter_at_offset(end)
+            )
 
-            recentevent = widget
 
     def focus(self):
         self.__conversation.update_read_timestamp()
         Gio.Application.get_default().withdraw_notification(self.__conversation.id_)
 
 
-    def destroy(self, widget):
+    def __destroyed(self, widget):
+        self.__is_destroyed = True
+        if self.__window_check:
+            GLib.source_remove(self.__window_check)
+            self.__window_check = None
+        if self.__history_timeout:
+            GLib.source_remove(self.__history_timeout)
+            self.__history_timeout = None
         self.__conversation.disconnect_on_event(self.__add_event_callback)
+        for message, (row, handler) in self.__pending.items():
+            message.disconnect(handler)
+        self.__pending.clear()
@@ -0,0 +1,157 @@
+# This file is part of Hangouts GTK
+# Copyright © 2019-2020 Dominik Schütz <do.sch.dev@gmail.com>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from bisect import bisect_right
+
+from gi.repository import Gio, GObject
+
+from hangups.conversation_event import ChatMessageEvent
+
+# create new bubble after 20 minutes
+GROUP_TIMEOUT = 20 * 60
+
+
+# consecutive chat messages of one user or a single other event,
+# shown as one row of the MessageBox
+class MessageGroup(GObject.Object):
+
+    def __init__(self, events):
+        super().__init__()
+        self.events = events
+
+    def get_first_timestamp(self):
+        return self.events[0].timestamp
+
+    def get_last_timestamp(self):
+        return self.events[-1].timestamp
+
+    def get_user_id(self):
+        return self.events[0].user_id
+
+    def accepts(self, event, neighbour):
+        first = self.events[0]
+        return isinstance(event, ChatMessageEvent) and \
+            isinstance(first, ChatMessageEvent) and \
+            event.user_id == first.user_id and \
+            abs(event.timestamp - neighbour.timestamp).total_seconds() < GROUP_TIMEOUT
+
+
+# timeline of a conversation as Gio.ListStore of MessageGroups,
+# events can be added in any order and are only added once
+class MessageListModel(GObject.Object):
+
+    __gsignals__ = {
+        # (position of group, event, index of event in group), emitted if
+        # an event was appended or prepended to an existing group
+        "group-extended": (GObject.SignalFlags.RUN_FIRST, None, (int, object, int))
+    }
+
+    def __init__(self):
+        super().__init__()
+        self.__store = Gio.ListStore.new(MessageGroup)
+        self.__groups = list()
+        self.__first_timestamps = list()
+        self.__event_ids = set()
+
+
+    def get_store(self):
+        return self.__store
+
+
+    def get_n_items(self):
+        return len(self.__groups)
+
+
+    def get_item(self, position):
+        return self.__groups[position]
+
+
+    def has_event(self, event_id):
+        return event_id in self.__event_ids
+
+
+    def get_first_event(self):
+        return self.__groups[0].events[0] if self.__groups else None
+
+
+    def get_last_event(self):
+        return self.__groups[-1].events[-1] if self.__groups else None
+
+
+    def find_event(self, event_id):
+        # position of group containing event_id or None
+        if event_id not in self.__event_ids:
+            return None
+        for position in range(len(self.__groups) - 1, -1, -1):
+            if any(e.id_ == event_id for e in self.__groups[position].events):
+                return position
+        return None
+
+
+    def add_events(self, events):
+        for event in sorted(events, key=lambda e: e.timestamp):
+            if event.id_ in self.__event_ids:
+                continue
+            self.__event_ids.add(event.id_)
+            self.__add_event(event)
+
+
+    def __splice(self, position, removed, groups):
+        self.__groups[position:position + removed] = groups
+        self.__first_timestamps[position:position + removed] = \
+            [g.get_first_timestamp() for g in groups]
+        self.__store.splice(position, removed, groups)
+
+
+    def __add_event(self, event):
+        timestamp = event.timestamp
+        # number of groups starting before or with event
+        position = bisect_right(self.__first_timestamps, timestamp)
+
+        previous = self.__groups[position - 1] if position > 0 else None
+        following = self.__groups[position] if position < len(self.__groups) else None
+
+        if previous and timestamp >= previous.get_last_timestamp():
+            # event comes after previous group
+            if previous.accepts(event, previous.events[-1]):
+                previous.events.append(event)
+                self.emit("group-extended", position - 1, event, len(previous.events) - 1)
+            elif following and following.accepts(event, following.events[0]):
+                following.events.insert(0, event)
+                self.__first_timestamps[position] = timestamp
+                self.emit("group-extended", position, event, 0)
+            else:
+                self.__splice(position, 0, [MessageGroup([event])])
+
+        elif previous:
+            # event is inside previous group, split it
+            index = bisect_right([e.timestamp for e in previous.events], timestamp)
+            if previous.accepts(event, previous.events[index - 1]):
+                previous.events.insert(index, event)
+                self.__splice(position - 1, 1, [previous])
+            else:
+                head = MessageGroup(previous.events[:index])
+                tail = MessageGroup(previous.events[index:])
+                self.__splice(position - 1, 1, [head, MessageGroup([event]), tail])
+
+        elif following and following.accepts(event, following.events[0]):
+            # event comes before every group
+            following.events.insert(0, event)
+            self.__first_timestamps[0] = timestamp
+            self.emit("group-extended", 0, event, 0)
+
+        else:
+            self.__splice(0, 0, [MessageGroup([event])])
@@ -15,37 +15,12 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import hangups
-import cairo
-import math
 import os
 
 from gi.repository import Gtk, GLib, Gdk, Pango
-from ..backend.image_cache import PROFILE_PHOTO_SMALL, SENT_IMAGE_PREVIEW
-
-
-def _convert_chat_message_segments_2_markup(chat_message_segments):
-    markup = ""
-    for segment in chat_message_segments:
-        seg_text: str = segment.text
-        seg_text = GLib.markup_escape_text(seg_text)
-        # if segment.type_ == hangouts_pb2.SEGMENT_TYPE_TEXT:
-        if segment.is_bold:
-            seg_text = "<b>{0}</b>".format(seg_text)
-        if segment.is_italic:
-            seg_text = "<i>{0}</i>".format(seg_text)
-        if segment.is_strikethrough:
-            seg_text = "<s>{0}</s>".format(seg_text)
-        if segment.is_underline:
-            seg_text = "<u>{0}</u>".format(seg_text)
-        if segment.link_target:
-            seg_text = "<a href=\"{0}\">{1}</a>".format(
-                GLib.markup_escape_text(segment.link_target),
-                GLib.markup_escape_text(seg_text)
-            )
-
-        markup += seg_text
-
-    return markup
+from ..backend.image_cache import PROFILE_PHOTO_SMALL, SENT_IMAGE_PREVIEW, PRIORITY_LOW
+from ..backend.markup import render_markup
+from ..widgets.animated_image import AnimatedImage
 
 
 def _time_2_local(ts):
@@ -71,19 +46,22 @@ def save_image(parent_window, image_cache, url):
     res = dialog.run()
     if res == Gtk.ResponseType.OK:
         filename = dialog.get_filename()
-        type = os.path.splitext(filename)[1][1:]
-        if type == "jpg":
-            type = "jpeg"
-        if type not in ("jpeg", "png", "tiff", "ico", "bmp"):
-            type = "png"
-
-        def save(pixbuf):
-            print("saving...")
-            pixbuf.savev(filename, type, [], [])
-        image_cache.get_image(url, save, None)
+
+        def saved(error):
+            if error is None:
+                print("saved ", filename)
+
+        # original file is written as is, no decoding and encoding
+        image_cache.save_image(url, filename, saved)
     dialog.destroy()
 
 
+def _cancel_requests(widget):
+    for cancellable in widget._requests:
+        cancellable.cancel()
+    widget._requests.clear()
+
+
 def build_image_right_click(widget: Gtk.Widget, image_cache, url):
     def right_click(widget, event: Gdk.EventButton):
         if event.button == 1:
@@ -92,12 +70,101 @@ def build_image_right_click(widget: Gtk.Widget, image_cache, url):
     widget.connect("button-press-event", right_click)
 
 
+# messages of a group in one widget, consecutive texts share a label
+# and only attached images split it
+class MessageBubble(Gtk.Box):
+
+    __gtype_name__ = "MessageBubble"
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+
+        # running image requests, cancelled when bubble is destroyed
+        self._requests = list()
+        self.connect("destroy", _cancel_requests)
+
+        # text runs and images from top to bottom, a text run is
+        # [label, markup of each message]
+        self.__parts = list()
+
+    def append(self, chatmessage_event, image_cache):
+        # add attached images
+        for att in chatmessage_event.attachments:
+            image_box = self.__add_image(att, image_cache)
+            self.__parts.append(image_box)
+            self.reorder_child(image_box, -1)
+
+        # message text
+        markup = render_markup(chatmessage_event)
+        if markup:
+            if self.__parts and not isinstance(self.__parts[-1], Gtk.EventBox):
+                run = self.__parts[-1]
+                run[1].append(markup)
+            else:
+                run = [self.__add_label(), [markup]]
+                self.__parts.append(run)
+                self.reorder_child(run[0], -1)
+            run[0].set_markup("\n".join(run[1]))
+
+    def prepend(self, chatmessage_event, image_cache):
+        # message text
+        markup = render_markup(chatmessage_event)
+        if markup:
+            if self.__parts and not isinstance(self.__parts[0], Gtk.EventBox):
+                run = self.__parts[0]
+                run[1].insert(0, markup)
+            else:
+                run = [self.__add_label(), [markup]]
+                self.__parts.insert(0, run)
+                self.reorder_child(run[0], 0)
+            run[0].set_markup("\n".join(run[1]))
+
+        # add attached images
+        for att in reversed(chatmessage_event.attachments):
+            image_box = self.__add_image(att, image_cache)
+            self.__parts.insert(0, image_box)
+            self.reorder_child(image_box, 0)
+
+    def __add_label(self):
+        end = self.get_halign() == Gtk.Align.END
+        label = Gtk.Label()
+        label.set_selectable(True)
+        label.set_halign(self.get_halign())
+        label.set_justify(Gtk.Justification.RIGHT if end else Gtk.Justification.LEFT)
+        label.set_xalign(1 if end else 0)
+        label.set_line_wrap(True)
+        label.set_line_wrap_mode(Pango.WrapMode.WORD_CHAR)
+        label.set_max_width_chars(30)
+        label.show()
+        self.pack_start(label, False, True, 0)
+        return label
+
+    def __add_image(self, url, image_cache):
+        # images have no window of their own to get clicks
+        event_box = Gtk.EventBox(halign=self.get_halign())
+        image = AnimatedImage(image_cache, url, SENT_IMAGE_PREVIEW)
+        event_box.add(image)
+        self.pack_start(event_box, False, True, 0)
+
+        build_image_right_click(event_box, image_cache, url)
+
+        image.show()
+        event_box.show()
+        self._requests.append(image_cache.get_image(
+            url,
+            image.set_preview,
+            SENT_IMAGE_PREVIEW,
+            priority=PRIORITY_LOW
+        ))
+        return event_box
+
+
 @Gtk.Template(resource_path="/com/dosch/HangoutsGTK/ui/chat_message_own.ui")
 class ChatMessageOwn(Gtk.Box):
 
     __gtype_name__ = "ChatMessageOwn"
 
-    messages: Gtk.ListBox = Gtk.Template.Child()
+    messages: MessageBubble = Gtk.Template.Child()
     time: Gtk.Label = Gtk.Template.Child()
 
     def __init__(self, chatmessageevent, image_cache, *args, **kwargs):
@@ -113,65 +180,15 @@ class ChatMessageOwn(Gtk.Box):
 
         self.show()
 
-    def append(self, chatmessage_event, image_cache):
-        # add attached images
-        for att in chatmessage_event.attachments:
-            image = Gtk.Image()
-            self.messages.add(image)
-
-            build_image_right_click(self, image_cache, att)
-
-            image.show()
-            image_cache.get_image(
-                att,
-                image.set_from_pixbuf,
-                SENT_IMAGE_PREVIEW
-            )
+    def set_status(self, status):
+        # shown instead of the time while message is not sent
+        self.time.set_text(status)
 
-        # message text
-        markup = _convert_chat_message_segments_2_markup(chatmessage_event.segments)
-        if markup:
-            label = Gtk.Label()
-            label.set_selectable(True)
-            label.set_markup(markup)
-            label.set_halign(Gtk.Align.END)
-            label.set_justify(Gtk.Justification.RIGHT)
-            label.set_xalign(1)
-            label.set_line_wrap(True)
-            label.set_line_wrap_mode(Pango.WrapMode.WORD_CHAR)
-            label.set_max_width_chars(30)
-            label.show()
-            self.messages.add(label)
+    def append(self, chatmessage_event, image_cache):
+        self.messages.append(chatmessage_event, image_cache)
 
     def prepend(self, chatmessage_event, image_cache):
-        # message text
-        markup = _convert_chat_message_segments_2_markup(chatmessage_event.segments)
-        if markup:
-            label = Gtk.Label()
-            label.set_selectable(True)
-            label.set_markup(markup)
-            label.set_halign(Gtk.Align.END)
-            label.set_justify(Gtk.Justification.RIGHT)
-            label.set_xalign(1)
-            label.set_line_wrap(True)
-            label.set_line_wrap_mode(Pango.WrapMode.WORD_CHAR)
-            label.set_max_width_chars(30)
-            label.show()
-            self.messages.prepend(label)
-
-        # add attached images
-        for att in reversed(chatmessage_event.attachments):
-            image = Gtk.Image()
-            self.messages.prepend(image)
-
-            build_image_right_click(self, image_cache, att)
-
-            image.show()
-            image_cache.get_image(
-                att,
-                image.set_from_pixbuf,
-                SENT_IMAGE_PREVIEW
-            )
+        self.messages.prepend(chatmessage_event, image_cache)
 
 
 @Gtk.Template(resource_path="/com/dosch/HangoutsGTK/ui/chat_message_foreign.ui")
@@ -179,117 +196,59 @@ class ChatMessageForeign(Gtk.Box):
 
     __gtype_name__ = "ChatMessageForeign"
 
-    messages: Gtk.ListBox = Gtk.Template.Child()
+    messages: MessageBubble = Gtk.Template.Child()
     time: Gtk.Label = Gtk.Template.Child()
     profile_photo: Gtk.DrawingArea = Gtk.Template.Child()
     name: Gtk.Label = Gtk.Template.Child()
 
-    def __init__(self, chatmessageevent, image_cache, user_dict, *args, **kwargs):
+    def __init__(self, chatmessageevent, image_cache, user_directory, *args, **kwargs):
         super().__init__(*args, **kwargs)
 
+        # running image requests, cancelled when bubble is destroyed
+        self._requests = list()
+        self.connect("destroy", _cancel_requests)
+
         self.user_id = chatmessageevent.user_id
-        user = user_dict.get(chatmessageevent.user_id, None)
+        self.__image_cache = image_cache
+        self.__user_directory = user_directory
 
         self.append(chatmessageevent, image_cache)
 
         self.set_homogeneous(False)  # Do not know, why this one defaults to True
 
-        # message name
-        self.name.set_text(user.first_name if user is not None else "Unknown")
-
         # message time
         self.timestamp = chatmessageevent.timestamp
         time_str = _time_2_local(chatmessageevent.timestamp)
         self.time.set_text(time_str)
 
-        # make round image
-        def round(pix):
-
-            surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, self.profile_photo.props.pixel_size, self.profile_photo.props.pixel_size)
-            draw_surface = Gdk.cairo_surface_create_from_pixbuf(pix, 0, self.profile_photo.props.window)
-
-            def paint(wid, cr):
-                cr.set_source_surface(draw_surface, 0, 0)
-                smaller_one = pix.props.width if pix.props.width < pix.props.height else pix.props.height
-                cr.arc(pix.props.width * .5, pix.props.height * .5, smaller_one * .5, 0, 2 * math.pi)
-                cr.clip()
-                cr.paint()
-
-                return False
-
-            self.profile_photo.connect("draw", paint)
-            self.profile_photo.set_from_surface(surface)
-
-        # message profile photo
-        if user is not None:
-            image_cache.get_image(
-                user.photo_url,
-                round,
-                size=PROFILE_PHOTO_SMALL,
-                cache=True
-            )
+        # message name and profile photo, again when an unknown user is
+        # fetched
+        self.__show_user()
+        user_changed_handler = user_directory.connect("user-changed", self.__user_changed)
+        self.connect("destroy", lambda widget: user_directory.disconnect(user_changed_handler))
 
         self.show()
 
-    def append(self, chatmessage_event, image_cache):
-        # add attached images
-        for att in chatmessage_event.attachments:
-            image = Gtk.Image()
-            self.messages.add(image)
+    def __show_user(self):
+        self.name.set_text(self.__user_directory.get_first_name(self.user_id))
 
-            build_image_right_click(self, image_cache, att)
+        photo_url = self.__user_directory.get_photo_url(self.user_id)
+        if photo_url is not None:
+            self._requests.append(self.__image_cache.get_avatar(
+                [photo_url],
+                self.profile_photo.set_from_surface,
+                PROFILE_PHOTO_SMALL[0]
+            ))
 
-            image.show()
-            image_cache.get_image(
-                att,
-                image.set_from_pixbuf,
-                SENT_IMAGE_PREVIEW
-            )
+    def __user_changed(self, user_directory, user_id):
+        if user_id == self.user_id:
+            self.__show_user()
 
-        # message text
-        markup = _convert_chat_message_segments_2_markup(chatmessage_event.segments)
-        if markup:
-            label = Gtk.Label()
-            label.set_selectable(True)
-            label.set_markup(markup)
-            label.set_halign(Gtk.Align.START)
-            label.set_justify(Gtk.Justification.LEFT)
-            label.set_xalign(0)
-            label.set_line_wrap(True)
-            label.set_line_wrap_mode(Pango.WrapMode.WORD_CHAR)
-            label.set_max_width_chars(30)
-            label.show()
-            self.messages.add(label)
+    def append(self, chatmessage_event, image_cache):
+        self.messages.append(chatmessage_event, image_cache)
 
     def prepend(self, chatmessage_event, image_cache):
-        # message text
-        markup = _convert_chat_message_segments_2_markup(chatmessage_event.segments)
-        if markup:
-            label = Gtk.Label()
-            label.set_selectable(True)
-            label.set_markup(markup)
-            label.set_halign(Gtk.Align.START)
-            label.set_justify(Gtk.Justification.LEFT)
-            label.set_xalign(0)
-            label.set_line_wrap(True)
-            label.set_line_wrap_mode(Pango.WrapMode.WORD_CHAR)
-            label.set_max_width_chars(30)
-            label.show()
-            self.messages.prepend(label)
-
-        # add attached images
-        for att in reversed(chatmessage_event.attachments):
-            image = Gtk.Image()
-            self.messages.prepend(image)
-
-            build_image_right_click(self, image_cache, att)
-
-            image.show()
-            image_cache.get_image(
-                att,
-                image.set_from_pixbuf,
-                SENT_IMAGE_PREVIEW
-            )
+        self.messages.prepend(chatmessage_event, image_cache)
 
 
 @Gtk.Template(resource_path="/com/dosch/HangoutsGTK/ui/chat_info.ui")
@@ -308,13 +267,12 @@ class ChatInfo(Gtk.Box):
         time = _time_2_local(event.timestamp)
         self.time.set_text(time)
 
-    def set_hangout_event(self, hangout_event, user_dict):
+    def set_hangout_event(self, hangout_event, user_directory):
         # call-start-symbolic call-missed-symbolic call-stop-symbolic folder-video-symbolic
         self.image.set_from_icon_name("folder-video-symbolic", self.image.props.icon_size)
         self.set_time(hangout_event)
         text = "UNDEFINED"
-        user = user_dict.get(hangout_event.user_id, None)
-        user_name = user.first_name if user is not None else "Unknown"
+        user_name = user_directory.get_first_name(hangout_event.user_id)
         if hangout_event.event_type == hangups.HANGOUT_EVENT_TYPE_START:
             text = "{0} started a call".format(user_name)
         elif hangout_event.event_type == hangups.HANGOUT_EVENT_TYPE_END:
@@ -332,10 +290,9 @@ class ChatInfo(Gtk.Box):
 
         self.show_all()
 
-    def set_membership_change_event(self, membership_change_event, user_dict):
+    def set_membership_change_event(self, membership_change_event, user_directory):
         text = "UNDEFINED"
-        user = user_dict.get(membership_change_event.user_id, None)
-        user_name = user.first_name if user is not None else "Unknown"
+        user_name = user_directory.get_first_name(membership_change_event.user_id)
         if membership_change_event.type_ is hangups.MEMBERSHIP_CHANGE_TYPE_JOIN:
             self.image.set_from_stock(Gtk.STOCK_QUIT, self.image.props.icon_size)
 
@@ -362,10 +319,9 @@ class ChatInfoTimeless(Gtk.Box):
         self.image.set_from_stock(Gtk.STOCK_EDIT, self.image.props.icon_size)
         self.show_all()
 
-    def set_rename_event(self, rename_event, user_dict):
+    def set_rename_event(self, rename_event, user_directory):
         self.image.set_from_stock(Gtk.STOCK_EDIT, self.image.props.icon_size)
-        user = user_dict.get(rename_event.user_id, None)
-        user_name = user.first_name if user is not None else "Unknown"
+        user_name = user_directory.get_first_name(rename_event.user_id)
         text = "{0} has renamed the Conversation in {1}".format(
             user_name,
             rename_event.new_name
@@ -383,11 +339,10 @@ class ChatInfoTimeless(Gtk.Box):
         self.text.set_text(text)
         self.show_all()
 
-    def set_group_sharing_event(self, group_sharing_event, user_dict):
+    def set_group_sharing_event(self, group_sharing_event, user_directory):
         self.image.set_from_icon_name("send-to-symbolic", self.image.props.icon_size)
         text = "UNDEFINED"
-        user = user_dict.get(group_sharing_event.user_id, None)
-        user_name = user.first_name if user is not None else "Unknown"
+        user_name = user_directory.get_first_name(group_sharing_event.user_id)
         if group_sharing_event.new_status is hangups.GROUP_LINK_SHARING_STATUS_ON:
             text = "{0} has enabled group sharing".format(user_name)
         else:
@@ -0,0 +1,124 @@
+# This file is part of Hangouts GTK
+# Copyright © 2019-2020 Dominik Schütz <do.sch.dev@gmail.com>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from gi.repository import Gtk, GObject, GLib, Pango
+
+from ..backend.conversation_snapshot import get_message_markup
+from ..widgets.message_views import _time_2_local
+
+SEARCH_RESULTS = 50
+
+
+# search entry with the best matching messages of all conversations
+class SearchPopover(Gtk.Popover):
+
+    __gsignals__ = {
+        # (conversation_id, event_id) of chosen message
+        "result-activated": (GObject.SignalFlags.RUN_FIRST, None, (str, str))
+    }
+
+    def __init__(self, conversation_list=None, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+
+        self.__conversation_list = conversation_list
+
+        box = Gtk.Box(orientation=Gtk.Orientation.VERTICAL, spacing=6, margin=6)
+
+        self.__entry = Gtk.SearchEntry(placeholder_text="Search messages")
+        self.__entry.connect("search-changed", self.__search)
+        self.__entry.connect("stop-search", lambda entry: self.popdown())
+        box.pack_start(self.__entry, False, True, 0)
+
+        self.__results = Gtk.ListBox()
+        self.__results.set_placeholder(Gtk.Label(label="No messages found", visible=True))
+        self.__results.connect("row-activated", self.__activated)
+
+        scrolled_window = Gtk.ScrolledWindow(
+            hscrollbar_policy=Gtk.PolicyType.NEVER,
+            min_content_height=300,
+            min_content_width=320
+        )
+        scrolled_window.add(self.__results)
+        box.pack_start(scrolled_window, True, True, 0)
+
+        box.show_all()
+        self.add(box)
+
+        self.connect("show", lambda popover: self.__entry.grab_focus())
+
+
+    def set_conversation_list(self, conversation_list):
+        # results of the former list are gone with it
+        self.__conversation_list = conversation_list
+        self.__entry.set_text("")
+        self.__results.foreach(lambda row: row.destroy())
+
+
+    def __search(self, entry):
+        self.__results.foreach(lambda row: row.destroy())
+        if self.__conversation_list is None:
+            return
+
+        hits = self.__conversation_list.search(entry.get_text(), limit=SEARCH_RESULTS)
+        for conversation_id, event_id in hits:
+            row = self.__create_row(conversation_id, event_id)
+            if row:
+                self.__results.add(row)
+
+
+    def __create_row(self, conversation_id, event_id):
+        try:
+            conversation = self.__conversation_list.get(conversation_id)
+        except KeyError:
+            return None
+        event = conversation.get_cached_event(event_id)
+        if event is None:
+            return None
+
+        if conversation.name:
+            name = conversation.name
+        else:
+            name = ", ".join(
+                map(lambda u: u.full_name,
+                    filter(lambda u: not u.is_self, conversation.users)
+            ))
+
+        title = Gtk.Label(xalign=0, ellipsize=Pango.EllipsizeMode.END, hexpand=True)
+        title.set_markup("<b>{}</b>".format(GLib.markup_escape_text(name)))
+        time = Gtk.Label(label=_time_2_local(event.timestamp))
+        time.get_style_context().add_class("dim-label")
+        text = Gtk.Label(xalign=0, ellipsize=Pango.EllipsizeMode.END)
+        text.set_markup(get_message_markup(conversation, event) or "")
+
+        header = Gtk.Box(spacing=6)
+        header.pack_start(title, True, True, 0)
+        header.pack_start(time, False, True, 0)
+
+        box = Gtk.Box(orientation=Gtk.Orientation.VERTICAL, margin=6)
+        box.pack_start(header, False, True, 0)
+        box.pack_start(text, False, True, 0)
+
+        row = Gtk.ListBoxRow()
+        row.add(box)
+        row.conversation_id = conversation_id
+        row.event_id = event_id
+        row.show_all()
+        return row
+
+
+    def __activated(self, listbox, row):
+        self.popdown()
+        self.emit("result-activated", row.conversation_id, row.event_id)